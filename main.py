@@ -1,17 +1,23 @@
 #!/usr/bin/env python
 # PYTHON_ARGCOMPLETE_OK
 
+import sys
 import time
+import cProfile
 import logging
 import argparse
 import argcomplete
 
 from manpage.directory import ManDirectoryParser
+from manpage.helpers import templates
+from manpage.benchmark import benchmark_pipeline
+from manpage.profiling import timer, tracer
 
 
 def dirparse(args):
     parser = ManDirectoryParser(database=args.database)
-    parser.parse_directory(source_dir=args.source_dir)
+    parser.parse_directory(
+        source_dir=args.source_dir, jobs=args.jobs, full=args.full)
 
     mps = args.missing_parsers
 
@@ -26,7 +32,12 @@ def imaging(args):
 
 def generate(args):
     parser = ManDirectoryParser(database=args.database)
-    parser.generate_output(output_dir=args.output_dir, base_url=args.base_url)
+    parser.generate_output(
+        output_dir=args.output_dir,
+        base_url=args.base_url,
+        jobs=args.jobs,
+        full=args.full,
+        aliases=args.aliases)
 
     scs = args.section_counters
     if scs:
@@ -38,10 +49,25 @@ def generate(args):
         print "Top %s missing links: %s" % (
             mls, parser.missing_links.most_common(mls))
 
+    stats = parser.link_stats
+    logging.info("Links: %s fragments from memo, %s linkified, %s skipped",
+                 stats['hits'], stats['misses'], stats['skipped'])
+
 def generate_indexes(args):
     parser = ManDirectoryParser(database=args.database)
     parser.generate_indexes(output_dir=args.output_dir, base_url=args.base_url)
 
+def bench(args):
+    regressed = benchmark_pipeline(
+        source_dir=args.source_dir,
+        repeat=args.repeat,
+        output=args.output,
+        baseline=args.baseline,
+        threshold=args.threshold)
+
+    if regressed:
+        sys.exit(1)
+
 if __name__ == '__main__':
     start_time = time.time()
 
@@ -52,6 +78,33 @@ if __name__ == '__main__':
         "--database",
         help="the database you want to use",
         default="manpages.db")
+    parser.add_argument(
+        "--profile",
+        help="time every page by stage and show the given amount of "
+        "slowest pages at the end",
+        type=int,
+        default=0)
+    parser.add_argument(
+        "--profile-stats",
+        help="write cProfile stats of the run to this file, for snakeviz "
+        "or pstats. Only this process is profiled, use --jobs 1 to "
+        "include the pages",
+        metavar="FILE")
+    parser.add_argument(
+        "--trace",
+        help="write a Chrome trace-event timeline of the run to this file, "
+        "with the phases and every page parsed or rendered, for "
+        "chrome://tracing or ui.perfetto.dev",
+        metavar="FILE")
+    parser.add_argument(
+        "--low-memory",
+        help="read the pages from the database as they are needed instead "
+        "of loading them, for small machines like the Vagrant box. Slower.",
+        action="store_true")
+    parser.add_argument(
+        "--reload-templates",
+        help="read a template again whenever its file changes",
+        action="store_true")
     subparsers = parser.add_subparsers()
 
     # dirparse option
@@ -66,6 +119,15 @@ if __name__ == '__main__':
         help="choose the amount of missing parsers to display",
         type=int,
         default=0)
+    parser_dirparse.add_argument(
+        "--jobs",
+        help="number of worker processes used to parse pages",
+        type=int,
+        default=1)
+    parser_dirparse.add_argument(
+        "--full",
+        help="parse every page again, even the ones that did not change",
+        action="store_true")
 
     parser_dirparse.set_defaults(func=dirparse)
 
@@ -88,6 +150,23 @@ if __name__ == '__main__':
         help="choose the amount of section titles to display",
         type=int,
         default=0)
+    parser_generate.add_argument(
+        "--jobs",
+        help="number of worker processes used to render pages",
+        type=int,
+        default=1)
+    parser_generate.add_argument(
+        "--full",
+        help="render every page again, even the ones that did not change",
+        action="store_true")
+    parser_generate.add_argument(
+        "--aliases",
+        help="what to do with pages that are a .so alias of another one: "
+        "render a copy of it, write a small page redirecting to it or list "
+        "them in nginx-aliases.map for the nginx configuration (reload "
+        "nginx afterwards)",
+        choices=["copy", "redirect", "nginx"],
+        default="copy")
 
     parser_generate.set_defaults(func=generate)
 
@@ -124,6 +203,35 @@ if __name__ == '__main__':
 
     parser_imaging.set_defaults(func=imaging)
 
+    # bench option
+    parser_bench = subparsers.add_parser(
+        'bench',
+        help='Times the parse and render pipeline over a corpus',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_bench.add_argument(
+        "source_dir",
+        help="the corpus, laid out like the dirparse source",
+        nargs="?",
+        default="benchmarks/corpus")
+    parser_bench.add_argument(
+        "--repeat",
+        help="runs over the corpus, the best time of each page is kept",
+        type=int,
+        default=5)
+    parser_bench.add_argument(
+        "--output", help="write the results to this JSON file")
+    parser_bench.add_argument(
+        "--baseline",
+        help="JSON results of an earlier run to compare with, exits with "
+        "status 1 when a stage got slower than the threshold")
+    parser_bench.add_argument(
+        "--threshold",
+        help="percentage of throughput a stage may lose against the baseline",
+        type=float,
+        default=10)
+
+    parser_bench.set_defaults(func=bench)
+
     # Set bash autocompletion
     argcomplete.autocomplete(parser)
 
@@ -134,7 +242,23 @@ if __name__ == '__main__':
         log_level = getattr(logging, args.log_level.upper())
         logging.basicConfig(level=log_level)
 
-    args.func(args)
+    templates.reload = args.reload_templates
+    ManDirectoryParser.low_memory = args.low_memory
+    timer.enabled = bool(args.profile)
+    tracer.enabled = bool(args.trace)
+
+    if args.profile_stats:
+        profile = cProfile.Profile()
+        profile.runcall(args.func, args)
+        profile.dump_stats(args.profile_stats)
+    else:
+        args.func(args)
+
+    if args.profile:
+        timer.report(args.profile)
+
+    if args.trace:
+        tracer.save(args.trace)
 
     elapsed = time.time() - start_time
     logging.info("--- Total time: %s seconds ---" % (elapsed, ))
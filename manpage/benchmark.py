@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+"""Man Page Parser Benchmark"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+from parser import ManpageParser, Line
+from helpers import tokenize, entitize, open_page, dump_tree, page_name
+from manpage import BaseContainer, Table, AvailablePages
+from links import LinkResolver
+
+pjoin = os.path.join
+
+
+def page_length(page_file):
+    """Length of the content of a page, once decompressed. The size of a
+    compressed file depends on how well it compresses."""
+    if not page_name(page_file)[2]:
+        return os.path.getsize(page_file)
+
+    length = 0
+    try:
+        with open_page(page_file) as fp:
+            for chunk in iter(lambda: fp.read(1 << 16), ''):
+                length += len(chunk)
+    except (KeyError, IOError, EOFError):
+        # No decompressor or a broken file, it will not parse either
+        return os.path.getsize(page_file)
+
+    return length
+
+
+def longest_pages(source_dir, amount):
+    page_files = glob.glob("%s/*/*.*" % source_dir)
+    page_files.sort(key=page_length, reverse=True)
+
+    pages = []
+    for page_file in page_files:
+        try:
+            ManpageParser(page_file).process()
+        except Exception:
+            # Only pages that parse tell something about the parser
+            continue
+
+        pages.append(page_file)
+        if len(pages) == amount:
+            break
+
+    return pages
+
+
+def time_page(page_file, repeat):
+    """Best of repeat runs for reading and for processing a page"""
+    read_times, process_times = [], []
+    for _ in range(repeat):
+        start = time.time()
+        parser = ManpageParser(page_file)
+        read = time.time()
+        parser.process()
+        end = time.time()
+
+        read_times.append(read - start)
+        process_times.append(end - read)
+
+    return len(parser.lines), min(read_times), min(process_times)
+
+
+def legacy_tokenize(t):
+    """The character by character tokenizer tokenize replaced, kept as the
+    reference for the tokenizer benchmark"""
+    if not t:
+        tokens = []
+    elif ' ' not in t and '"' not in t:
+        tokens = [t]
+    elif '"' not in t and "\\ " not in t:
+        tokens = t.split(None)
+    else:
+        state = "start"
+        arg = ""
+        tokens = []
+        for char in t:
+            if state == "start":
+                if char == " ":
+                    continue
+                elif char == "\"":
+                    state = "inarg_quote"
+                else:
+                    state = "inarg"
+                    arg += char
+            elif state == "inarg_quote":
+                if char == "\"":
+                    state = "start"
+                    tokens.append(arg)
+                    arg = ""
+                else:
+                    arg += char
+            elif state == "inarg":
+                if char == " ":
+                    tokens.append(arg)
+                    arg = ""
+                    state = "start"
+                else:
+                    arg += char
+
+        if state in {"inarg", "inarg_quote"} and arg:
+            tokens.append(arg)
+
+    return tokens
+
+
+def macro_arguments(source_dir):
+    """Arguments of every macro line in the corpus, as tokenize gets them"""
+    arguments = []
+    for page_file in glob.glob("%s/*/*.*" % source_dir):
+        with open_page(page_file) as fp:
+            for line in fp:
+                if line[:1] not in {Line.cc, Line.c2}:
+                    continue
+
+                line = line.rstrip().split(Line.comment, 1)[0]
+                chunks = line[1:].lstrip().split(None, 1)
+                if len(chunks) == 2:
+                    arguments.append(entitize(chunks[1]))
+
+    return arguments
+
+
+def time_tokenizer(tokenizer, arguments, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for argument in arguments:
+            tokenizer(argument)
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def benchmark_tokenizer(source_dir, repeat):
+    arguments = macro_arguments(source_dir)
+    quoted = [a for a in arguments if '"' in a or "\\ " in a]
+    different = sum(1 for a in set(quoted)
+                    if tokenize(a) != legacy_tokenize(a))
+
+    print "%-20s %10s %12s %12s" % ("lines", "amount", "legacy ms",
+                                    "tokenize ms")
+    for name, lines in (("all", arguments), ("quoted", quoted)):
+        print "%-20s %10d %12.2f %12.2f" % (
+            name, len(lines),
+            time_tokenizer(legacy_tokenize, lines, repeat) * 1000,
+            time_tokenizer(tokenize, lines, repeat) * 1000)
+
+    print "%s distinct quoted lines tokenize differently" % different
+
+
+def page_tables(node):
+    """Every table in a page tree"""
+    if isinstance(node, Table):
+        yield node
+    elif isinstance(node, (BaseContainer, list, tuple)):
+        items = node.contents if isinstance(node, BaseContainer) else node
+        for item in items:
+            for table in page_tables(item):
+                yield table
+
+
+def corpus_tables(source_dir):
+    tables = []
+    for page_file in glob.glob("%s/*/*.*" % source_dir):
+        try:
+            tree = ManpageParser(page_file).process()
+        except Exception:
+            continue
+
+        tables.extend(page_tables(tree))
+
+    return tables
+
+
+def time_tables(tables, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for table in tables:
+            table.html()
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def benchmark_tables(source_dir, repeat):
+    tables = corpus_tables(source_dir)
+    largest = sorted(tables, key=lambda t: len(t.contents))[-10:]
+
+    print "%-20s %10s %12s" % ("tables", "amount", "ms")
+    for name, group in (("all", tables), ("10 largest", largest)):
+        print "%-20s %10d %12.2f" % (name, len(group),
+                                     time_tables(group, repeat) * 1000)
+
+
+def tree_size(node, seen=None):
+    """Bytes taken by a page tree: its objects, their __dict__ or slots,
+    and everything they refer to, counting shared objects once"""
+    if seen is None:
+        seen = set()
+
+    if id(node) in seen:
+        return 0
+
+    seen.add(id(node))
+    size = sys.getsizeof(node)
+    if isinstance(node, (list, tuple, set, frozenset)):
+        children = node
+    elif isinstance(node, dict):
+        children = node.keys() + node.values()
+    elif isinstance(node, BaseContainer):
+        children = [getattr(node, name)
+                    for cls in type(node).__mro__
+                    for name in getattr(cls, '__slots__', ())
+                    if hasattr(node, name)]
+        if hasattr(node, '__dict__'):
+            children.append(node.__dict__)
+    else:
+        children = ()
+
+    for child in children:
+        size += tree_size(child, seen)
+
+    return size
+
+
+def benchmark_memory(source_dir):
+    pages, nodes, size, pickled = 0, 0, 0, 0
+    for page_file in glob.glob("%s/*/*.*" % source_dir):
+        try:
+            tree = ManpageParser(page_file).process()
+        except Exception:
+            continue
+
+        pages += 1
+        size += tree_size(tree)
+        pickled += len(dump_tree(tree))
+
+    print "%-20s %10s %12s %12s" % ("trees", "pages", "KB", "bytes/page")
+    for name, total in (("in memory", size), ("stored", pickled)):
+        print "%-20s %10d %12.1f %12d" % (name, pages, total / 1024.0,
+                                          total / max(pages, 1))
+
+
+def benchmark_parser(source_dir, longest, repeat):
+    total_read, total_process = 0, 0
+    print "%-40s %8s %8s %10s %10s" % ("page", "KB", "lines", "read ms",
+                                       "process ms")
+    for page_file in longest_pages(source_dir, longest):
+        lines, read, process = time_page(page_file, repeat)
+        total_read += read
+        total_process += process
+
+        print "%-40s %8.1f %8d %10.2f %10.2f" % (
+            os.path.basename(page_file), page_length(page_file) / 1024.0,
+            lines, read * 1000, process * 1000)
+
+    print "%-40s %8s %8s %10.2f %10.2f" % ("total", "", "", total_read * 1000,
+                                           total_process * 1000)
+
+
+PIPELINE_STAGES = ("read", "process", "render", "write")
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of a sorted list"""
+    rank = int(round(percent / 100.0 * len(values) + 0.5))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def time_pipeline(page_file, output_dir):
+    """Seconds taken by every stage of the pipeline for a page, and the
+    bytes of the source and of the html"""
+    start = time.time()
+    parser = ManpageParser(page_file)
+    read = time.time()
+    manpage = parser.process()
+    process = time.time()
+    html = manpage.html()
+    render = time.time()
+    with open(pjoin(output_dir, "%s.%s.html" % (manpage.name,
+                                                manpage.section)), 'w') as fp:
+        fp.write(html)
+    write = time.time()
+
+    return ((read - start, process - read, render - process, write - render),
+            os.path.getsize(page_file), len(html))
+
+
+def run_pipeline(source_dir, repeat):
+    """Best of repeat runs of every stage for every page in the corpus
+    that parses, plus the pages that were left out"""
+    page_files = sorted(glob.glob("%s/*/*.*" % source_dir))
+    names = set("%s.%s" % page_name(page_file)[:2] for page_file in page_files)
+
+    AvailablePages.resolver = LinkResolver(names)
+    output_dir = tempfile.mkdtemp(prefix="bench-")
+    timings, skipped = dict(), []
+    try:
+        for _ in range(repeat):
+            for page_file in page_files:
+                if page_file in skipped:
+                    continue
+
+                try:
+                    times, source, html = time_pipeline(page_file, output_dir)
+                except Exception:
+                    # Redirections and pages the parser does not support
+                    skipped.append(page_file)
+                    continue
+
+                if page_file in timings:
+                    best = timings[page_file][0]
+                    times = tuple(min(t, b) for t, b in zip(times, best))
+
+                timings[page_file] = (times, source, html)
+
+                # The memo would turn every run after the first into lookups
+                AvailablePages.resolver.memo.clear()
+    finally:
+        AvailablePages.resolver = None
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    return timings, skipped
+
+
+def pipeline_results(source_dir, repeat):
+    timings, skipped = run_pipeline(source_dir, repeat)
+    pages = len(timings)
+    source = sum(s for _, s, _ in timings.values())
+    html = sum(h for _, _, h in timings.values())
+
+    stages = dict()
+    for i, stage in enumerate(PIPELINE_STAGES):
+        latencies = sorted(times[i] for times, _, _ in timings.values())
+        total = sum(latencies)
+        # Write throughput is measured on what gets written
+        size = html if stage == "write" else source
+        stages[stage] = {
+            "seconds": total,
+            "pages_per_second": pages / total if total else 0,
+            "mb_per_second": size / total / 2**20 if total else 0,
+            "p50_ms": percentile(latencies, 50) * 1000 if pages else 0,
+            "p99_ms": percentile(latencies, 99) * 1000 if pages else 0,
+        }
+
+    return {
+        "corpus": source_dir,
+        "pages": pages,
+        "skipped": [os.path.relpath(p, source_dir) for p in skipped],
+        "source_bytes": source,
+        "html_bytes": html,
+        "repeat": repeat,
+        "stages": stages,
+    }
+
+
+def pipeline_regressions(results, baseline, threshold):
+    """Stages whose throughput fell more than threshold percent under the
+    baseline, as (stage, baseline pages/s, pages/s)"""
+    regressions = []
+    for stage in PIPELINE_STAGES:
+        before = baseline["stages"].get(stage, {}).get("pages_per_second")
+        now = results["stages"][stage]["pages_per_second"]
+        if before and now < before * (1 - threshold / 100.0):
+            regressions.append((stage, before, now))
+
+    return regressions
+
+
+def benchmark_pipeline(source_dir, repeat, output=None, baseline=None,
+                       threshold=10):
+    """Times reading, processing, rendering and writing every page of a
+    corpus and compares the throughput with a baseline. Returns whether
+    it regressed."""
+    results = pipeline_results(source_dir, repeat)
+
+    if baseline:
+        with open(baseline) as fp:
+            baseline = json.load(fp)
+
+    print "%d pages, %.1f KB of source, %.1f KB of html" % (
+        results["pages"], results["source_bytes"] / 1024.0,
+        results["html_bytes"] / 1024.0)
+    print "%-10s %10s %10s %10s %10s %10s" % ("stage", "pages/s", "MB/s",
+                                              "p50 ms", "p99 ms", "baseline")
+    for stage in PIPELINE_STAGES:
+        numbers = results["stages"][stage]
+        if baseline and stage in baseline["stages"]:
+            before = baseline["stages"][stage]["pages_per_second"]
+            change = "%+.1f%%" % (
+                (numbers["pages_per_second"] / before - 1) * 100)
+        else:
+            change = ""
+
+        print "%-10s %10.1f %10.2f %10.2f %10.2f %10s" % (
+            stage, numbers["pages_per_second"], numbers["mb_per_second"],
+            numbers["p50_ms"], numbers["p99_ms"], change)
+
+    if results["skipped"]:
+        print "Skipped: %s" % ", ".join(results["skipped"])
+
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    regressions = []
+    if baseline:
+        regressions = pipeline_regressions(results, baseline, threshold)
+        for stage, before, now in regressions:
+            print "Regression in %s: %.1f pages/s, baseline %.1f" % (
+                stage, now, before)
+
+    return bool(regressions)
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--log-level", help="choose log level")
+    parser.add_argument(
+        "--longest",
+        help="amount of pages to benchmark, longest (decompressed) first",
+        type=int,
+        default=20)
+    parser.add_argument(
+        "--repeat", help="runs per measure, the best one is kept", type=int,
+        default=5)
+    parser.add_argument(
+        "--tokenizer",
+        help="benchmark the macro argument tokenizer instead of the parser",
+        action="store_true")
+    parser.add_argument(
+        "--tables",
+        help="benchmark the table renderer instead of the parser",
+        action="store_true")
+    parser.add_argument(
+        "--memory",
+        help="report the size of the page trees instead of timing the parser",
+        action="store_true")
+    parser.add_argument(
+        "source_dir", help="the directory you want to use as source")
+
+    args = parser.parse_args()
+
+    if args.log_level:
+        log_level = getattr(logging, args.log_level.upper())
+        logging.basicConfig(level=log_level)
+
+    if args.tokenizer:
+        benchmark_tokenizer(args.source_dir, args.repeat)
+    elif args.tables:
+        benchmark_tables(args.source_dir, args.repeat)
+    elif args.memory:
+        benchmark_memory(args.source_dir)
+    else:
+        benchmark_parser(args.source_dir, args.longest, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,321 @@
 import glob
+import json
 import shutil
+import hashlib
 import logging
 import os.path
 import sqlite3
 import datetime
 from cached_property import cached_property
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
+from itertools import imap
+from multiprocessing import Pool
 from PIL import Image, ImageDraw, ImageFont
 from textwrap import wrap
+from urllib import quote
 
 from helpers import pjoin, dname, bname
 from helpers import SECTIONS
 from helpers import load_template, get_breadcrumb
+from helpers import file_hash, dump_tree, load_tree
+from helpers import page_name, find_page, chunks
 
 from parser import ManpageParser
 from parser import NotSupportedFormat, UnexpectedMacro, RedirectedPage
+from parser import MalformedPage, PARSER_VERSION
 
-from manpage import AvailablePages, AvailableSections
+from manpage import AvailablePages
+from links import LinkResolver, LinkTargets, PageLookup
+from profiling import timer, tracer, traced, worker_imap
 
 package_directory = dname(os.path.abspath(__file__))
 
+CatalogPage = namedtuple("CatalogPage", [
+    "name", "section", "package", "path", "aliased", "packages", "subtitle",
+    "file", "prev_path", "prev_title", "next_path", "next_title", "alias_of"
+])
+
+
+def parse_page(page_file):
+    """Parses a page and returns a picklable outcome, so it can run in a
+    worker process while the parent keeps the database connection"""
+    try:
+        with timer.stage("lex"):
+            parser = ManpageParser(page_file)
+        with timer.stage("parse"):
+            manpage = parser.process()
+    except NotSupportedFormat:
+        return page_file, "unsupported", None
+    except RedirectedPage as e:
+        return page_file, "redirect", e.redirect
+    except IOError:
+        return page_file, "missing", None
+    except UnexpectedMacro as e:
+        macro = str(e).split('(', 1)[1].split(')', 1)[0]
+        return page_file, "missing-parser", macro
+    except MalformedPage as e:
+        return page_file, "malformed", e.reason
+    except Exception:
+        return page_file, "error", None
+
+    with timer.stage("store"):
+        tree = dump_tree(manpage)
+
+    return page_file, "parsed", (manpage.name, manpage.section, manpage.title,
+                                 tree)
+
+
+def check_page(item):
+    """Parses a page only when it changed since the last dirparse. The known
+    (size, mtime, hash, outcome, data, parser) of the page is compared first
+    by stat and then by content hash. The returned source is None when
+    nothing about the file needs to be stored again."""
+    page_file, known = item
+    if known and known[5] != PARSER_VERSION:
+        # From another version of the parser, the outcome may differ now
+        known = None
+
+    try:
+        stat = os.stat(page_file)
+    except OSError:
+        return page_file, "missing", None, None
+
+    size, mtime = stat.st_size, stat.st_mtime
+    if known and known[:2] == (size, mtime):
+        return page_file, known[3], known[4], None
+
+    timer.start_page(page_file)
+    timer.page_size(size)
+    with timer.stage("read"):
+        page_hash = file_hash(page_file)
+    if known and known[2] == page_hash:
+        return page_file, known[3], known[4], (size, mtime, page_hash)
+
+    with tracer.span(bname(page_file), "parse", file=page_file):
+        _, outcome, data = parse_page(page_file)
+
+    return page_file, outcome, data, (size, mtime, page_hash)
+
+
+def init_page_writer(database, manpages_dir, available_pages):
+    """Prepares a worker process to render pages on its own connection"""
+    global page_writer
+
+    page_writer = ManDirectoryParser(database=database)
+    page_writer.manpages_dir = manpages_dir
+    page_writer.available_pages = available_pages
+
+
+def write_page(page):
+    """Renders a page in a worker process and returns what the parent
+    records of it, along with the link stats it touched"""
+    page_writer.link_resolver.stats.clear()
+
+    links, counters = page_writer.write_page(**page)
+
+    return page, links, counters, page_writer.link_resolver.stats.copy()
+
+
+def resolve_redirects(redirects):
+    """Maps every redirected page to the page it ends up at, following
+    chains of redirections. Pages caught in a redirection loop map to
+    None."""
+    resolved = dict()
+    for page_file in redirects:
+        chain, in_chain = [], set()
+        target = page_file
+        while target in redirects and target not in resolved:
+            if target in in_chain:
+                loop = chain[chain.index(target):] + [target]
+                logging.warning("Redirection loop: %s", " -> ".join(loop))
+                final = None
+                break
+
+            chain.append(target)
+            in_chain.add(target)
+            target = redirects[target]
+        else:
+            final = resolved.get(target, target)
 
-class DirectoryIterator(object):
-    def __init__(self, iterator):
-        self.items = [(file, None) for file in iterator]
-        self.current = 0
-        self.high = len(self.items)
-        self.extra_items = []
-
-    def __iter__(self):
-        return self
+        for redirected in chain:
+            resolved[redirected] = final
 
-    def __next__(self):  # Compatibility with python 3
-        return self.next()
+    return resolved
 
-    def next(self):
-        if self.extra_items:
-            return self.extra_items.pop(0)
 
-        if self.current == self.high:
-            raise StopIteration
-        else:
-            self.current += 1
-            return self.items[self.current - 1]
+def nginx_string(text):
+    """text as a quoted string of an nginx configuration file"""
+    for character, escaped in (("\\", "\\\\"), ('"', '\\"'),
+                               ("\n", "\\n"), ("\t", "\\t"),
+                               ("\r", "\\r")):
+        text = text.replace(character, escaped)
 
-    def add_item(self, file, redirection):
-        self.extra_items.append((file, redirection))
+    return '"%s"' % text
 
 
 class ManDirectoryParser(object):
     """docstring for ManDirectoryParser"""
 
     now = datetime.datetime.today().strftime('%Y-%m-%d')
+    write_buffer = 1 << 16
+
+    # Rows queued before they are written in a single transaction
+    batch_size = 1000
+
+    # Reads the catalog page by page and looks pages up in the database
+    # instead of loading them, for machines with little memory
+    low_memory = False
+    low_memory_memo_size = 1000
 
     def __init__(self, database):
+        self.database = database
         self.conn = sqlite3.connect(
             pjoin(package_directory, "..", database), isolation_level=None)
         self.conn.text_factory = str
         self.cursor = self.conn.cursor()
 
+        # With WAL a commit does not wait for the disk and readers (the
+        # generate workers) do not block the writer. A crash may lose the
+        # last commits, never consistency.
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA cache_size = -65536")
+        self.pending = defaultdict(list)
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS parsed_pages
+                             (file text primary key,
+                              hash text,
+                              tree blob,
+                              parser integer)""")
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS rendered_pages
+                             (path text primary key,
+                              inputs text,
+                              links text,
+                              counters text)""")
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS sources
+                             (file text primary key,
+                              size integer,
+                              mtime real,
+                              hash text,
+                              outcome text,
+                              name text,
+                              section text,
+                              data text,
+                              parser integer)""")
+
+        # Databases from before these columns. Their pages are parsed and
+        # rendered again.
+        for table, column, kind in (("rendered_pages", "counters", "text"),
+                                    ("sources", "parser", "integer"),
+                                    ("parsed_pages", "parser", "integer")):
+            columns = [info[1] for info in self.conn.execute(
+                "PRAGMA table_info(%s)" % table)]
+            if column not in columns:
+                self.conn.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                                  (table, column, kind))
+
+        # Rows of manpages that come from a .so redirection, and the page
+        # they redirect to (in the same package)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS aliases
+                             (package text,
+                              name text,
+                              section text,
+                              target_name text,
+                              target_section text,
+                              primary key (package, name, section))""")
+
+        # Every page to render, in the order of the site: by section, name
+        # and package. It is rebuilt from manpages by every dirparse, and
+        # the output passes read it instead of grouping manpages again.
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS catalog
+                             (position integer primary key,
+                              name text,
+                              section text,
+                              package text,
+                              path text,
+                              aliased integer,
+                              packages text,
+                              subtitle text,
+                              file text,
+                              prev_path text,
+                              prev_title text,
+                              next_path text,
+                              next_title text)""")
+        self.conn.execute("""CREATE UNIQUE INDEX IF NOT EXISTS catalog_path
+                             ON catalog (path)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS catalog_package
+                             ON catalog (package, section, name)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS catalog_name
+                             ON catalog (name, section)""")
+
+        # Pages of the catalog that are an alias of another page of the
+        # catalog, and the path of that page
+        self.conn.execute("""CREATE VIEW IF NOT EXISTS catalog_aliases AS
+                             SELECT page.path AS path, target.path AS target
+                             FROM catalog AS page
+                             JOIN aliases USING (package, name, section)
+                             JOIN catalog AS target
+                               ON target.package = aliases.package
+                              AND target.name = aliases.target_name
+                              AND target.section = aliases.target_section""")
+
         self.pages = dict()
 
         self.missing_parsers = Counter()
 
+    @contextmanager
+    def transaction(self):
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        self.conn.execute("COMMIT")
+
+    def queue(self, statement, row):
+        """Writes the row on the next flush, along with many others"""
+        self.pending[statement].append(row)
+
+    def flush(self, batch=False):
+        """Writes the queued rows. In batch mode, only once there are enough
+        of them. Call it when the rows of a page are all queued, so a page
+        is never written halfway."""
+        queued = sum(len(rows) for rows in self.pending.itervalues())
+        if batch and queued < ManDirectoryParser.batch_size:
+            return
+
+        with self.transaction():
+            for statement, rows in self.pending.iteritems():
+                self.conn.executemany(statement, rows)
+
+        self.pending.clear()
+
     @property
     def missing_links(self):
-        return AvailablePages.unavailable
+        return self.rendered_counter("missing-links")
 
     @property
     def section_counters(self):
-        return AvailableSections.titles
+        return self.rendered_counter("sections")
+
+    def rendered_counter(self, name):
+        """A counter of every page, added up over all the rendered pages and
+        not only the ones of the last generate"""
+        total = Counter()
+        query = """SELECT counters FROM rendered_pages
+                   WHERE counters IS NOT NULL"""
+        for counters, in self.rows(query):
+            # Titles are not always valid utf-8, they go through latin-1
+            counter = json.loads(counters).get(name, {})
+            total.update({key.encode("latin-1"): amount
+                          for key, amount in counter.iteritems()})
+
+        return total
 
     def get_pages_without_errors(self):
         manpages = set()
@@ -92,66 +338,318 @@ class ManDirectoryParser(object):
 
         return pages_with_missing_parsers
 
-    def parse_directory(self, source_dir):
-        self.conn.execute("DELETE FROM manpages")
-
-        iterator = DirectoryIterator(glob.iglob("%s/*/*.*" % source_dir))
+    @traced
+    def parse_directory(self, source_dir, jobs=1, full=False):
+        # Pages and aliases are stored aside and only replace the ones of
+        # the last dirparse at the end, all at once
+        for table in ("manpages", "aliases"):
+            self.conn.execute("DROP TABLE IF EXISTS temp.new_%s" % table)
+            schema, = self.conn.execute(
+                "SELECT sql FROM main.sqlite_master WHERE name = ?",
+                (table, )).fetchone()
+            self.conn.execute(schema.replace(
+                "CREATE TABLE %s" % table,
+                "CREATE TEMP TABLE new_%s" % table, 1))
+
+        if full:
+            self.conn.execute("DELETE FROM sources")
+            self.conn.execute("DELETE FROM parsed_pages")
+
+        known = self.known_sources()
+        seen = set()
+        # File stored for every (package, name, section)
+        self.page_files = dict()
+
+        def item(page_file):
+            return page_file, known.get(page_file)
+
+        items = imap(item, glob.iglob("%s/*/*.*" % source_dir))
+
+        if jobs > 1:
+            # Workers only parse, this process is the single database writer
+            pool = Pool(jobs)
+            results = worker_imap(pool.imap, check_page, items, chunksize=16)
+            check = lambda f: pool.apply(check_page, (item(f), ))
+        else:
+            pool = None
+            results = imap(check_page, items)
+            check = lambda f: check_page(item(f))
 
-        for page_file, redirected_from in iterator:
-            logging.debug("Processing man page %s ...", page_file)
-            try:
-                parser = ManpageParser(page_file)
-                manpage = parser.process()
-            except NotSupportedFormat:
-                logging.info("Skipping %s, not supported format...", page_file)
-                continue
-            except RedirectedPage as e:
-                redirect_to = e.redirect
-                logging.info("Page %s, has a redirection to %s...", page_file,
-                             redirect_to)
+        # Redirected pages (.so stubs) only get a row once every page has
+        # been checked, from the outcome of the page they end up at. That
+        # way each target is parsed once, whatever the number of aliases.
+        redirects = dict()
+        outcomes = dict()
 
-                parent_dirs = redirect_to.count('/')
-                base_dir = dname(page_file)
-                while parent_dirs:
-                    base_dir = dname(base_dir)
-                    parent_dirs -= 1
+        def record(page_file, outcome, data, source):
+            if outcome != "missing":
+                seen.add(page_file)
 
-                redirection_full_path = pjoin(base_dir, redirect_to)
+            if source:
+                self.store_source(page_file, outcome, data, source)
 
-                if not redirected_from:
-                    original_file = page_file
-                else:
-                    original_file = redirected_from
+            if outcome == "redirect":
+                redirects[page_file] = self.redirect_target(page_file, data)
+                return
 
-                iterator.add_item(redirection_full_path, original_file)
-                continue
-            except IOError:
-                logging.info("Skipping %s, file (%s) does not exist",
-                             redirected_from, page_file)
-                continue
-            except UnexpectedMacro as e:
-                macro = str(e).split('(', 1)[1].split(')', 1)[0]
-                logging.info("Skipping %s, missing macro (%s)", page_file,
-                             macro)
-                self.missing_parsers[macro] += 1
-                continue
-            except:
-                print "Error in %s" % page_file
-                continue
+            outcomes[page_file] = (outcome, data)
+            if outcome == "parsed":
+                # Aliases share the tree stored for the page itself
+                outcomes[page_file] = (outcome, data[:3] + (None, ))
 
-            if not redirected_from:
-                name, section = manpage.name, manpage.section
-            else:
-                name, ext = os.path.splitext(bname(redirected_from))
-                section = ext[1:]
+        try:
+            for page_file, outcome, data, source in results:
+                record(page_file, outcome, data, source)
+                self.store_outcome(page_file, None, outcome, data, source)
+                self.flush(batch=True)
+
+            # Targets out of the source directory are checked on demand
+            pending = set(redirects.values())
+            while pending:
+                target = pending.pop()
+                if target in outcomes or target in redirects:
+                    continue
+
+                _, outcome, data, source = check(target)
+                record(target, outcome, data, source)
+                if outcome == "redirect":
+                    pending.add(redirects[target])
+                elif outcome == "parsed" and data[3]:
+                    self.store_manpage(target, source[2], data[3])
+
+                self.flush(batch=True)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        for page_file, target in sorted(resolve_redirects(redirects).items()):
+            if target is not None:
+                outcome, data = outcomes[target]
+                self.store_outcome(target, page_file, outcome, data, None)
+
+        self.flush()
+
+        gone = [(page_file, ) for page_file in set(known) - seen]
+        for page_file, in gone:
+            logging.info("Page %s no longer exists, forgetting it", page_file)
+
+        with self.transaction():
+            self.conn.executemany("DELETE FROM sources WHERE file = ?", gone)
+            self.conn.executemany("DELETE FROM parsed_pages WHERE file = ?",
+                                  gone)
+
+            for table in ("manpages", "aliases"):
+                self.conn.execute("DELETE FROM main.%s" % table)
+                self.conn.execute(
+                    "INSERT INTO main.%s SELECT * FROM temp.new_%s" %
+                    (table, table))
+                self.conn.execute("DROP TABLE temp.new_%s" % table)
+
+            self.build_catalog()
+
+    def build_catalog(self):
+        """Fills catalog from manpages. A page whose name.section is in
+        several packages is aliased: there is one for every package, with
+        the package as a prefix of its file name. Pages link to the previous
+        and next one in their section."""
+        query = "SELECT package, name, section, subtitle, file FROM manpages"
+        manpages = {(package, name, section): (subtitle, file)
+                    for package, name, section, subtitle, file in
+                    self.conn.execute(query)}
 
-            package = bname(dname(page_file))
+        query = """SELECT name,
+                          section,
+                          count(package) as amount,
+                          group_concat(package) as packages
+                   FROM manpages
+                   GROUP by name, section
+                   ORDER by section ASC, name ASC"""
 
+        rows = []
+        for name, section, amount, packages in self.conn.execute(query):
+            # group_concat does not promise any order
+            packages = sorted(packages.split(','))
+            for package in packages:
+                subtitle, file = manpages[(package, name, section)]
+                filename = "%s.%s.html" % (name, section)
+                if amount > 1:
+                    filename = "%s-%s" % (package, filename)
+
+                rows.append({
+                    "position": len(rows),
+                    "name": name,
+                    "section": section,
+                    "package": package,
+                    "path": pjoin("man%s" % section[0], filename),
+                    "aliased": amount > 1,
+                    "packages": ','.join(packages),
+                    "subtitle": subtitle,
+                    "file": file,
+                    "title": "%s.%s: %s" % (name, section, subtitle),
+                    "prev_path": None,
+                    "prev_title": None,
+                    "next_path": None,
+                    "next_title": None,
+                })
+
+        for prev, page in zip(rows, rows[1:]):
+            if prev['section'] == page['section']:
+                page['prev_path'] = bname(prev['path'])
+                page['prev_title'] = prev['title']
+                prev['next_path'] = bname(page['path'])
+                prev['next_title'] = page['title']
+
+        self.conn.execute("DELETE FROM catalog")
+        self.conn.executemany(
+            """INSERT INTO catalog VALUES (:position, :name, :section,
+               :package, :path, :aliased, :packages, :subtitle, :file,
+               :prev_path, :prev_title, :next_path, :next_title)""", rows)
+
+    def known_sources(self):
+        query = """SELECT file, size, mtime, hash, outcome, name, section, data,
+                          parser
+                   FROM sources"""
+
+        known = dict()
+        for (file, size, mtime, page_hash, outcome, name, section, data,
+             parser) in self.conn.execute(query):
+            if outcome == "parsed":
+                # The tree is kept in parsed_pages already
+                data = (name, section, data, None)
+
+            known[file] = (size, mtime, page_hash, outcome, data, parser)
+
+        return known
+
+    def store_source(self, page_file, outcome, data, source):
+        size, mtime, page_hash = source
+        if outcome == "parsed":
+            name, section, data, _ = data
+        else:
+            name, section = None, None
+
+        self.queue(
+            "INSERT OR REPLACE INTO sources (file, size, mtime, hash, outcome, name, section, data, parser) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (page_file, size, mtime, page_hash, outcome, name, section, data,
+             PARSER_VERSION))
+
+    def redirect_target(self, page_file, redirect_to):
+        """The file a .so line in page_file points to"""
+        logging.info("Page %s, has a redirection to %s...", page_file,
+                     redirect_to)
+
+        parent_dirs = redirect_to.count('/')
+        base_dir = dname(page_file)
+        while parent_dirs:
+            base_dir = dname(base_dir)
+            parent_dirs -= 1
+
+        return find_page(pjoin(base_dir, redirect_to))
+
+    def store_outcome(self, page_file, redirected_from, outcome, data,
+                      source):
+        logging.debug("Processing man page %s ...", page_file)
+        if outcome == "unsupported":
+            logging.info("Skipping %s, not supported format...", page_file)
+            return
+        elif outcome == "redirect":
+            # Stored once the redirections are resolved
+            return
+        elif outcome == "missing":
+            logging.info("Skipping %s, file (%s) does not exist",
+                         redirected_from, page_file)
+            return
+        elif outcome == "missing-parser":
+            macro = data
+            logging.info("Skipping %s, missing macro (%s)", page_file, macro)
+            self.missing_parsers[macro] += 1
+            return
+        elif outcome == "malformed":
+            logging.warning("Skipping %s, malformed page (%s)", page_file,
+                            data)
+            return
+        elif outcome == "error":
+            print "Error in %s" % page_file
+            return
+
+        name, section, subtitle, tree = data
+        package = bname(dname(page_file))
+
+        if redirected_from:
+            target_name, target_section = name, section
+            name, section, _ = page_name(redirected_from)
+
+        key = (package, name, section)
+        page_source = redirected_from or page_file
+        stored = self.page_files.get(key)
+        if stored is not None and stored != page_source:
+            # Like ls.1 next to ls.1.gz, after a package is fetched again
+            kept = self.preferred_page_file(stored, page_source)
+            logging.warning("%s and %s are both %s(%s) in %s, keeping %s",
+                            stored, page_source, name, section, package,
+                            kept)
+            if kept == stored:
+                return
+
+            # The rows of the other file go away before the ones of this one
+            self.flush()
             self.conn.execute(
-                "INSERT INTO manpages (package, name, section, subtitle, file) VALUES (?, ?, ?, ?, ?)",
-                (package, name, section, manpage.title, page_file))
+                "DELETE FROM new_aliases WHERE package = ? AND name = ? AND section = ?",
+                key)
+
+        self.page_files[key] = page_source
+
+        if redirected_from:
+            self.queue(
+                "INSERT OR REPLACE INTO new_aliases (package, name, section, target_name, target_section) VALUES (?, ?, ?, ?, ?)",
+                (package, name, section, target_name, target_section))
+
+        self.queue(
+            "INSERT OR REPLACE INTO new_manpages (package, name, section, subtitle, file) VALUES (?, ?, ?, ?, ?)",
+            (package, name, section, subtitle, page_file))
+
+        if tree:
+            self.store_manpage(page_file, source[2], tree)
+
+        logging.debug("Man page %s processed correctly...", page_file)
+
+    @staticmethod
+    def preferred_page_file(*page_files):
+        """Of the files of the same page, the one to keep: the newest one
+        and, as old as each other, the plain one"""
+        def preference(page_file):
+            try:
+                mtime = os.path.getmtime(page_file)
+            except OSError:
+                mtime = 0
+
+            return mtime, not page_name(page_file)[2], page_file
+
+        return max(page_files, key=preference)
+
+    def store_manpage(self, page_file, page_hash, tree):
+        # Aliases share the tree of the page they redirect to
+        self.queue(
+            "INSERT OR REPLACE INTO parsed_pages (file, hash, tree, parser) VALUES (?, ?, ?, ?)",
+            (page_file, page_hash, sqlite3.Binary(tree), PARSER_VERSION))
 
-            logging.debug("Man page %s processed correctly...", page_file)
+    def load_manpage(self, page_file):
+        query = "SELECT hash, tree, parser FROM parsed_pages WHERE file = ?"
+        row = self.conn.execute(query, (page_file, )).fetchone()
+
+        if (row and row[2] == PARSER_VERSION and
+                row[0] == file_hash(page_file)):
+            try:
+                return load_tree(row[1])
+            except ValueError:
+                logging.debug("Stale parsed tree for %s", page_file)
+
+        logging.debug("No parsed tree for %s, parsing it again", page_file)
+        with timer.stage("lex"):
+            parser = ManpageParser(page_file)
+        with timer.stage("parse"):
+            return parser.process()
 
     def empty_output_directories(self):
         shutil.rmtree(self.manpages_dir, ignore_errors=True)
@@ -169,80 +667,229 @@ class ManDirectoryParser(object):
         except OSError:
             pass
 
-    def get_pagination_link(self, package, name, section, aliases=False):
-        basefile = "%s.%s.html" % (name, section)
-        if aliases:
-            basefile = "%s-%s" % (package, basefile)
-
-        link_text = "%s.%s: %s" % (name, section,
-                                   self.subtitles[(package, name, section)])
+    @traced
+    def create_manpages(self, jobs=1, full=False, aliases="copy"):
+        if not full:
+            self.remove_stale_pages(aliases)
 
-        return (basefile, link_text)
-
-    def create_manpages(self):
-        query = """SELECT name,
-                          section,
-                          count(package) as amount,
-                          group_concat(package) as packages,
-                          file
-                   FROM manpages
-                   GROUP by name, section
-                   ORDER by section ASC, name ASC"""
-
-        pages = []
-        current_section = None
-        for name, section, amount, packages, file in self.conn.execute(query):
-            first_page_in_section = (section != current_section)
-            if first_page_in_section:
-                current_section = section
-                prev_page = None
-
-            parent_dir = "man%s" % section[0]
+        for page in self.catalog:
+            packages = page.packages.split(',')
+            if page.aliased and page.package == packages[0]:
+                # Once for all the packages of the page
+                # FIXME Create aliases page
+                self.write_aliases_page(page.name, page.section,
+                                        dname(page.path), packages)
+
+        if aliases != "copy":
+            query = "SELECT count(*) FROM catalog_aliases"
+            logging.info("%s aliases redirect to the page they alias",
+                         self.conn.execute(query).fetchone()[0])
+
+        if aliases == "redirect":
+            self.write_redirect_pages(self.alias_redirects())
+        elif aliases == "nginx":
+            self.write_aliases_map(self.aliases_map, self.alias_redirects())
+
+        if aliases != "nginx" and os.path.exists(self.aliases_map):
+            os.remove(self.aliases_map)
+
+        # Where the map was written before, it would be published
+        published_map = pjoin(self.root_html, "nginx-aliases.map")
+        if os.path.exists(published_map):
+            os.remove(published_map)
+
+        pages = self.pages_to_render(full, aliases != "copy")
+        if jobs > 1:
+            self.write_pages(pages, jobs)
+        else:
+            for page in pages:
+                self.record_page(page, *self.write_page(**page))
+
+        self.flush()
+
+    def pages_to_render(self, full=False, skip_aliases=False):
+        """The pages of the catalog to render, as arguments of write_page.
+        Aliases of a page are left out with skip_aliases, and unless full so
+        are the pages that are still as they were rendered."""
+        pages = outdated = 0
+        for page in self.catalog:
+            if skip_aliases and page.alias_of:
+                continue
 
             page_dict = {
-                "name": name,
-                "section": section,
-                "parent_dir": parent_dir,
-                "file": file
+                "name": page.name,
+                "section": page.section,
+                "parent_dir": dname(page.path),
+                "file": page.file,
+                "package": page.package,
             }
 
-            if amount > 1:
-                # Aliases needed
-                packages = packages.split(',')
-                for package in packages:
-                    package_dict = page_dict.copy()
-                    package_dict['package'] = package
-                    package_dict['prefix'] = package
-
-                    current_page = self.get_pagination_link(
-                        package, name, section, aliases=True)
-
-                    if prev_page:
-                        package_dict['prev_page'] = prev_page
-                        pages[-1]['next_page'] = current_page
-
-                    prev_page = current_page
-
-                    pages.append(package_dict)
+            if page.aliased:
+                page_dict['prefix'] = page.package
+
+            if page.prev_path:
+                page_dict['prev_page'] = (page.prev_path, page.prev_title)
+
+            if page.next_path:
+                page_dict['next_page'] = (page.next_path, page.next_title)
+
+            pages += 1
+            if full or not self.is_rendered(page_dict):
+                outdated += 1
+                yield page_dict
+
+        if not full:
+            logging.info("%s out of %s pages needed to be rendered",
+                         outdated, pages)
+
+    def alias_redirects(self):
+        """(alias path, target path) of every alias whose target is rendered
+        too, sorted"""
+        return self.rows("""SELECT path, target FROM catalog_aliases
+                            ORDER BY path, target""")
+
+    @traced
+    def write_redirect_pages(self, redirects):
+        redirect_tpl = load_template('redirect')
+        for path, target in redirects:
+            url = "%s/%s" % (self.manpages_url, target)
+            with open(pjoin(self.manpages_dir, path), 'w') as f:
+                f.write(redirect_tpl.substitute(url=url))
+
+            # Recorded like any other page, so it is removed when it is not
+            # needed any more
+            self.queue(
+                "INSERT OR REPLACE INTO rendered_pages (path, inputs, links) VALUES (?, ?, ?)",
+                (path, repr(["redirect", url]), "[]"))
+            self.flush(batch=True)
+
+        self.flush()
+
+    @traced
+    def write_aliases_map(self, map_file, redirects):
+        """Writes the entries of the nginx map in nginx-default-conf, from
+        alias URI to the URI of the page it aliases. $uri is decoded, so the
+        alias is quoted as it is and the target, a URI, is escaped."""
+        prefix = "/%s/" % self.manpages_dir_name
+        with open(map_file, 'w') as f:
+            for path, target in redirects:
+                f.write("%s %s;\n" % (nginx_string(prefix + path),
+                                      nginx_string(quote(prefix + target))))
 
-                # FIXME Create aliases page
-                self.write_aliases_page(name, section, parent_dir, packages)
-
-            else:
-                page_dict['package'] = packages
+    @property
+    def aliases_map(self):
+        """The map of --aliases nginx, next to the database and not in the
+        output directory, which is published as it is"""
+        return pjoin(package_directory, "..", self.database + ".aliases.map")
+
+    def page_inputs(self, page):
+        # Everything but links the rendered page depends on. It is only
+        # compared for equality, and subtitles are not always valid utf-8
+        return repr([
+            self.source_hash(page['file']), PARSER_VERSION,
+            self.templates_hash,
+            page['package'], page.get('prev_page'), page.get('next_page')
+        ])
+
+    @traced
+    def remove_stale_pages(self, aliases="copy"):
+        """Removes the rendered pages that are not in the catalog any more.
+        Aliases of a page are not rendered for nginx, it redirects them."""
+        query = """SELECT path FROM rendered_pages
+                   WHERE path NOT IN (SELECT path FROM catalog)"""
+        if aliases == "nginx":
+            query += " OR path IN (SELECT path FROM catalog_aliases)"
+
+        removed = self.conn.execute(query).fetchall()
+        for path, in removed:
+            logging.info("Removing manpage %s", path)
+            try:
+                os.remove(pjoin(self.manpages_dir, path))
+            except OSError:
+                pass
+
+        with self.transaction():
+            self.conn.executemany("DELETE FROM rendered_pages WHERE path = ?",
+                                  removed)
+
+    def is_rendered(self, page):
+        """Whether the page was rendered from the same inputs as now and its
+        links still go to the same pages"""
+        path = self.page_path(**page)
+        query = """SELECT inputs, links, counters FROM rendered_pages
+                   WHERE path = ?"""
+        rendered = self.conn.execute(query, (path, )).fetchone()
+        if rendered is None or self.source_hash(page['file']) is None or \
+                not os.path.exists(pjoin(self.manpages_dir, path)):
+            return False
+
+        inputs, links, counters = rendered
+        if counters is None:
+            # Rendered before the counters were kept
+            return False
+
+        return inputs == self.page_inputs(page) and all(
+            self.link_target(link) == target
+            for link, target in json.loads(links))
+
+    def record_page(self, page, links, counters):
+        self.queue(
+            "INSERT OR REPLACE INTO rendered_pages (path, inputs, links, counters) VALUES (?, ?, ?, ?)",
+            (self.page_path(**page), self.page_inputs(page),
+             json.dumps(sorted(links.items())),
+             json.dumps(counters, encoding="latin-1")))
+        self.flush(batch=True)
+
+    def link_target(self, link):
+        return self.link_resolver.resolve(link)
 
-                current_page = self.get_pagination_link(packages, name,
-                                                        section)
+    @cached_property
+    def link_resolver(self):
+        if self.low_memory:
+            return LinkResolver(self.available_pages,
+                                ManDirectoryParser.low_memory_memo_size)
 
-                if prev_page:
-                    page_dict['prev_page'] = prev_page
-                    pages[-1]['next_page'] = current_page
+        return LinkResolver(self.available_pages)
 
-                prev_page = current_page
+    @property
+    def link_stats(self):
+        return self.link_resolver.stats
 
-                pages.append(page_dict)
+    def source_hash(self, page_file):
+        query = "SELECT hash FROM parsed_pages WHERE file = ?"
+        row = self.conn.execute(query, (page_file, )).fetchone()
+        return row and row[0]
 
-        map(lambda page: self.write_page(**page), pages)
+    @cached_property
+    def templates_hash(self):
+        digest = hashlib.sha1()
+        for template in sorted(glob.glob("templates/*.tpl")):
+            digest.update(template)
+            digest.update(file_hash(template))
+
+        return digest.hexdigest()
+
+    @traced
+    def write_pages(self, pages, jobs):
+        # Links and pagination are resolved here once, workers only render
+        pool = Pool(
+            jobs,
+            initializer=init_page_writer,
+            initargs=(self.database, self.manpages_dir, self.available_pages))
+
+        # The pool takes its tasks from a thread of its own, which can not
+        # use the connections of this one: the pages are handed over in
+        # lists, all of them at once unless memory is short
+        size = ManDirectoryParser.batch_size if self.low_memory else None
+        try:
+            for chunk in chunks(pages, size):
+                for page, links, counters, stats in worker_imap(
+                        pool.imap_unordered, write_page, chunk, chunksize=16):
+                    self.record_page(page, links, counters)
+                    self.link_stats.update(stats)
+        finally:
+            pool.terminate()
+            pool.join()
 
     def write_page(self,
                    package,
@@ -253,27 +900,56 @@ class ManDirectoryParser(object):
                    prefix=None,
                    prev_page=None,
                    next_page=None):
-        filename = "%s.%s.html" % (name, section)
-
         logging.info("Creating manpage %s.%s", name, section)
 
-        if prefix:
-            filename = "%s-%s" % (prefix, filename)
+        path = self.page_path(name, section, parent_dir, prefix)
+        filename = bname(path)
+        full_path = pjoin(self.manpages_dir, path)
+
+        with tracer.span(filename, "render", file=file):
+            timer.start_page(path)
+            with timer.stage("read"):
+                mp = self.load_manpage(file)
+
+            mp.package = package
+            mp.prev_page = prev_page
+            mp.next_page = next_page
+            mp.url = "https://www.carta.tech/man-pages/man%s/%s" % (section,
+                                                                    filename, )
+            AvailablePages.resolver = self.link_resolver
+            AvailablePages.requested = set()
+            AvailablePages.unavailable = Counter()
+
+            logging.debug("Writing %s" % full_path)
+            with open(full_path, 'w', ManDirectoryParser.write_buffer) as f:
+                if timer.enabled:
+                    # Rendered apart from writing, so each gets its own time
+                    with timer.stage("template"):
+                        html = mp.html()
+                    with timer.stage("write"):
+                        f.write(html)
+                    timer.page_size(len(html))
+                else:
+                    mp.write(f)
 
-        full_path = pjoin(self.manpages_dir, parent_dir, filename)
+        links = AvailablePages.requested
+        # Kept with the page, so they can be reported without rendering it
+        counters = {
+            "missing-links": AvailablePages.unavailable,
+            "sections": Counter(mp.section_titles),
+        }
+        AvailablePages.requested = None
+        AvailablePages.unavailable = Counter()
 
-        mp = ManpageParser(file).process()
-        mp.package = package
-        mp.prev_page = prev_page
-        mp.next_page = next_page
-        mp.url = "https://www.carta.tech/man-pages/man%s/%s" % (section,
-                                                                filename, )
-        AvailablePages.pages = self.available_pages
+        return {link: self.link_target(link) for link in links}, counters
 
-        logging.debug("Writing %s" % full_path)
-        f = open(full_path, 'w')
-        f.write(mp.html())
-        f.close()
+    @staticmethod
+    def page_path(name, section, parent_dir, prefix=None, **kwargs):
+        filename = "%s.%s.html" % (name, section)
+        if prefix:
+            filename = "%s-%s" % (prefix, filename)
+
+        return pjoin(parent_dir, filename)
 
     def write_aliases_page(self, name, section, parent_dir, packages):
         filename = "%s.%s.html" % (name, section)
@@ -286,39 +962,86 @@ class ManDirectoryParser(object):
         return full_path
 
     @cached_property
+    @traced
     def available_pages(self):
+        if self.low_memory:
+            self.check_catalog()
+            return PageLookup(pjoin(package_directory, "..", self.database))
+
+        # Written next to the database and mapped, workers share it
         query = "SELECT DISTINCT name, section FROM manpages"
-        return set(["%s.%s" % (name, section)
-                    for name, section in self.conn.execute(query)])
+        path = pjoin(package_directory, "..", self.database + ".links")
+        LinkTargets.build(path, ("%s.%s" % (name, section)
+                                 for name, section in self.conn.execute(query)))
+
+        return LinkTargets(path)
+
+    # Pages that are an alias of another one come with the path of that one
+    catalog_query = """SELECT name, section, package, path, aliased, packages,
+                              subtitle, file, prev_path, prev_title,
+                              next_path, next_title, target
+                       FROM catalog
+                       LEFT JOIN catalog_aliases USING (path)
+                       ORDER BY position"""
 
     @cached_property
-    def subtitles(self):
-        query = "SELECT package, name, section, subtitle FROM manpages"
-        return {
-            (package, name, section): subtitle
-            for package, name, section, subtitle in self.conn.execute(query)
-        }
+    def reader(self):
+        """A connection for the rows streamed in low memory mode, as a commit
+        of the main connection would reset them halfway"""
+        conn = sqlite3.connect(pjoin(package_directory, "..", self.database),
+                               isolation_level=None)
+        conn.text_factory = str
+        return conn
+
+    def rows(self, query):
+        """The rows of a query, all at once or, in low memory mode, as they
+        are read"""
+        if self.low_memory:
+            return self.reader.execute(query)
+
+        return self.conn.execute(query).fetchall()
+
+    def check_catalog(self):
+        # Databases from before the catalog get it built here
+        if self.conn.execute("SELECT 1 FROM catalog LIMIT 1").fetchone():
+            return
+
+        with self.transaction():
+            self.build_catalog()
+
+    @property
+    def catalog(self):
+        """Every page of the catalog, in order. A list, loaded once, or in
+        low memory mode the rows read again every time."""
+        if self.low_memory:
+            self.check_catalog()
+            return imap(CatalogPage._make, self.rows(self.catalog_query))
+
+        return self.catalog_pages
 
+    @cached_property
+    def catalog_pages(self):
+        self.check_catalog()
+        return [CatalogPage._make(row)
+                for row in self.conn.execute(self.catalog_query)]
+
+    def redirected_aliases(self):
+        """Paths of the aliases that the last generate did not render as
+        copies: they are redirection pages, or nginx redirects them"""
+        query = """SELECT path FROM catalog_aliases
+                   WHERE path NOT IN (SELECT path FROM rendered_pages
+                                      WHERE inputs NOT LIKE '[''redirect''%')"""
+        return {path for path, in self.conn.execute(query)}
+
+    @traced
     def generate_manpage_sitemaps(self):
-        query = """SELECT name,
-                          section,
-                          count(package) as amount,
-                          group_concat(package) as packages,
-                          file
-                   FROM manpages
-                   GROUP by name, section
-                   ORDER by section ASC, name ASC"""
+        # Search engines only get the URL of the page an alias redirects to
+        redirected = self.redirected_aliases()
 
         pages_in_section = defaultdict(set)
-        for name, section, amount, packages, file in self.conn.execute(query):
-            if amount > 1:
-                packages = packages.split(',')
-                for package in packages:
-                    page = "%s-%s.%s.html" % (package, name, section, )
-                    pages_in_section["man%s" % section[0]].add(page)
-            else:
-                page = "%s.%s.html" % (name, section, )
-                pages_in_section["man%s" % section[0]].add(page)
+        for page in self.catalog:
+            if page.path not in redirected:
+                pages_in_section[dname(page.path)].add(bname(page.path))
 
         sm_item_tpl = load_template('sitemap-url-nolastmod')
 
@@ -343,6 +1066,7 @@ class ManDirectoryParser(object):
 
         return sitemap_urls
 
+    @traced
     def generate_manpage_sitemap_index(self, urls):
         sitemap_index_url_tpl = load_template('sitemap-index-url')
         urls = [sitemap_index_url_tpl.substitute(url=url) for url in urls]
@@ -353,6 +1077,7 @@ class ManDirectoryParser(object):
         f.write(content)
         f.close()
 
+    @traced
     def generate_package_indexes(self):
         item_tpl = load_template('package-index-item')
         package_index_tpl = load_template('package-index')
@@ -361,27 +1086,11 @@ class ManDirectoryParser(object):
         package_list_item_tpl = load_template('package-list-item')
         sm_item_tpl = load_template('sitemap-url-nolastmod')
 
-        query = """SELECT name,
-                          section,
-                          count(package) as amount,
-                          group_concat(package) as packages
-                   FROM manpages
-                   GROUP by name, section
-                   ORDER by package ASC, section ASC, name ASC"""
-
         package_container = defaultdict(lambda: defaultdict(list))
-
-        for name, section, amount, packages in self.conn.execute(query):
-            if amount > 1:
-                for package in packages.split(','):
-                    subtitle = self.subtitles[(package, name, section)]
-                    package_container[package][section].append(
-                        ("%s.%s" % (name, section), subtitle, True))
-
-            else:
-                subtitle = self.subtitles[(packages, name, section)]
-                package_container[packages][section].append(
-                    ("%s.%s" % (name, section), subtitle, False))
+        for page in self.catalog:
+            package_container[page.package][page.section].append(
+                ("%s.%s" % (page.name, page.section), page.subtitle,
+                 page.aliased))
 
         package_list_items = []
         sitemap_urls = []
@@ -389,6 +1098,7 @@ class ManDirectoryParser(object):
             package_directory = pjoin(self.packages_dir, package)
             self.makedirs(package_directory)
 
+            timer.start_page(pjoin(self.packages_dir_name, package))
             package_index = []
             for section, pages in sorted(sections.items()):
                 full_section = "man%s" % (section[0], )
@@ -439,10 +1149,13 @@ class ManDirectoryParser(object):
                 breadcrumb=get_breadcrumb(breadcrumb),
                 content=contents,
                 metadescription="Man Pages in %s" % package, )
+            timer.lap("template")
 
             f = open(pjoin(package_directory, "index.html"), 'w')
             f.write(out)
             f.close()
+            timer.lap("write")
+            timer.page_size(len(out))
 
             package_list_items.append(
                 package_list_item_tpl.substitute(
@@ -479,62 +1192,27 @@ class ManDirectoryParser(object):
         f.write(out)
         f.close()
 
+    @traced
     def generate_manpage_indexes(self):
-        query = """SELECT name,
-                          section,
-                          count(package) as amount,
-                          group_concat(package) as packages
-                   FROM manpages
-                   GROUP by name, section
-                   ORDER by section ASC, name ASC"""
-
         section_item_tpl = load_template('section-index-item')
         section_item_manpage_tpl = load_template('section-index-item-manpage')
         items = defaultdict(list)
-        for name, section, amount, packages in self.conn.execute(query):
-            page = "%s.%s" % (name, section)
-            if amount > 1:
-                for package in packages.split(','):
-                    subtitle = self.subtitles[(package, name, section)]
-
-                    if package == "man-pages":
-                        items[section].append(
-                            section_item_manpage_tpl.substitute(
-                                link=page,
-                                name=name,
-                                section=section,
-                                description=subtitle,
-                                package=package))
-                    else:
-                        items[section].append(
-                            section_item_tpl.substitute(
-                                link=page,
-                                name=name,
-                                section=section,
-                                description=subtitle,
-                                package=package))
-
+        for page in self.catalog:
+            if page.package == "man-pages":
+                item_tpl = section_item_manpage_tpl
             else:
-                subtitle = self.subtitles[(packages, name, section)]
-
-                if packages == "man-pages":
-                    items[section].append(
-                        section_item_manpage_tpl.substitute(
-                            link=page,
-                            name=name,
-                            section=section,
-                            description=subtitle,
-                            package=packages))
-                else:
-                    items[section].append(
-                        section_item_tpl.substitute(
-                            link=page,
-                            name=name,
-                            section=section,
-                            description=subtitle,
-                            package=packages))
+                item_tpl = section_item_tpl
+
+            items[page.section].append(
+                item_tpl.substitute(
+                    link="%s.%s" % (page.name, page.section),
+                    name=page.name,
+                    section=page.section,
+                    description=page.subtitle,
+                    package=page.package))
 
         for section in items:
+            timer.start_page(pjoin(self.manpages_dir_name, "man%s" % section[0]))
             section_content = load_template('section-index').substitute(
                 items=''.join(items[section[0]]))
 
@@ -554,12 +1232,16 @@ class ManDirectoryParser(object):
                 breadcrumb=get_breadcrumb(breadcrumb),
                 content=section_content,
                 metadescription=section_description.replace("\"", "\'"), )
+            timer.lap("template")
 
             f = open(
                 pjoin(self.manpages_dir, "man%s" % section[0], 'index.html'), 'w')
             f.write(out)
             f.close()
+            timer.lap("write")
+            timer.page_size(len(out))
 
+    @traced
     def generate_manpage_index(self):
         # Generate man-pages index
         base_tpl = load_template('base')
@@ -578,6 +1260,7 @@ class ManDirectoryParser(object):
         f.write(index)
         f.close()
 
+    @traced
     def generate_base_index(self):
         # Generate base index
         base_tpl = load_template('base')
@@ -596,20 +1279,21 @@ class ManDirectoryParser(object):
         f.write(index)
         f.close()
 
+    @traced
     def generate_images(self, output_dir):
         images_dir = pjoin(output_dir, "images")
 
         shutil.rmtree(images_dir, ignore_errors=True)
         ManDirectoryParser.makedirs(images_dir)
 
-        for (package, name,
-             section), description in self.subtitles.iteritems():
-
-            filename = "%s-%s-%s.png" % (package,
-                                         name,
-                                         section, )
+        for page in self.catalog:
+            filename = "%s-%s-%s.png" % (page.package,
+                                         page.name,
+                                         page.section, )
+            timer.start_page(filename)
             ManDirectoryParser.write_image(
-                pjoin(images_dir, filename), name, section, description)
+                pjoin(images_dir, filename), page.name, page.section,
+                page.subtitle)
 
     @staticmethod
     def write_image(filename, name, section, description):
@@ -632,9 +1316,18 @@ class ManDirectoryParser(object):
         d.text((30,100), description, font=fnt2, fill=(0,0,0,255))
 
         out = Image.alpha_composite(base, txt)
-        out.save(filename)
+        timer.lap("draw")
 
-    def generate_output(self, output_dir, base_url):
+        out.save(filename)
+        timer.lap("write")
+
+    @traced
+    def generate_output(self,
+                        output_dir,
+                        base_url,
+                        jobs=1,
+                        full=False,
+                        aliases="copy"):
         self.root_html = output_dir
 
         self.manpages_dir_name = "man-pages"
@@ -645,15 +1338,18 @@ class ManDirectoryParser(object):
         self.manpages_url = base_url + "man-pages"
         self.packages_url = base_url + "packages"
 
-        # Delete output directories
-        self.empty_output_directories()
+        if full:
+            # Delete output directories
+            self.empty_output_directories()
+            self.conn.execute("DELETE FROM rendered_pages")
 
         # Create placeholder directories
         self.create_output_directories()
 
         # Create Manpages
-        self.create_manpages()
+        self.create_manpages(jobs=jobs, full=full, aliases=aliases)
 
+    @traced
     def generate_indexes(self, output_dir, base_url):
         self.root_html = output_dir
 
@@ -1,9 +1,12 @@
 import os.path
-import shlex
-from string import Template
-from repoze.lru import lru_cache
-import collections
+import bz2
+import glob
+import gzip
+import zlib
+import hashlib
+import cPickle
 from itertools import islice
+from string import Template
 from HTMLParser import HTMLParser
 
 try:
@@ -11,83 +14,114 @@ try:
 except ImportError:
     import re
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# A macro argument is either quoted, where "" stands for a quote and a
+# missing closing quote ends it at the end of the line, or a run of
+# characters up to the next space, where "\ " does not split
+macro_argument = re.compile(r'"((?:[^"]+|"")*)("?)|((?:[^ \\]+|\\.?)+)')
+
 
 def tokenize(t):
-    # FiXME "\ " is going to break everything
     # https://www.gnu.org/software/groff/manual/html_node/Request-and-Macro-Arguments.html
     if not t:
-        tokens = []
+        return []
     elif ' ' not in t and '"' not in t:
-        tokens = [t]
+        return [t]
     elif '"' not in t and "\\ " not in t:
-        tokens = t.split(None)
-    else:
-        #print "(%s)" % (t,)
-
-        state = "start"
-        arg = ""
-        tokens = []
-        for char in t:
-            if state == "start":
-                if char == " ":
-                    continue
-                elif char == "\"":
-                    state = "inarg_quote"
-                    continue
-                else:
-                    state = "inarg"
-                    arg += char
-                    continue
-
-            if state == "inarg_quote":
-                if char == "\"":
-                    state = "start"
-                    tokens.append(arg)
-                    arg = ""
-                    continue
-                else:
-                    arg += char
-                    continue
-
-            if state == "inarg":
-                if char == " ":
-                    tokens.append(arg)
-                    arg = ""
-                    state = "start"
-                    continue
-                else:
-                    arg += char
-                    continue
-        else:
-            if state in {"inarg", "inarg_quote"}:
-                if arg:
-                    tokens.append(arg)
-                    arg = ""
-                    state = "start"
-            elif state == "start":
-                pass
+        return t.split(None)
+
+    return [
+        unquoted or quoted.replace('""', '"')
+        for quoted, closed, unquoted in macro_argument.findall(t)
+        if unquoted or quoted or closed
+    ]
+
+
+class CompiledTemplate(object):
+    """A string.Template turned into a %-format string once, so rendering it
+    is a single formatting operation"""
+    __slots__ = ('format', )
+
+    def __init__(self, text):
+        def convert(match):
+            name = match.group('named') or match.group('braced')
+            if name is not None:
+                return "%%(%s)s" % name
+            elif match.group('escaped') is not None:
+                return Template.delimiter
             else:
-                raise Exception("Args should be empty %s" % state)
+                raise ValueError("Invalid placeholder %r in template" %
+                                 match.group(0))
 
-    return tokens
+        self.format = Template.pattern.sub(convert, text.replace('%', '%%'))
 
+    def substitute(self, **kwargs):
+        return self.format % kwargs
 
-def consume(iterator, n):
-    "Advance the iterator n-steps ahead. If n is none, consume entirely."
-    # Use functions that consume iterators at C speed.
-    if n is None:
-        # feed the entire iterator into a zero-length deque
-        collections.deque(iterator, maxlen=0)
-    else:
-        # advance to the empty slice starting at position n
-        next(islice(iterator, n, n), None)
+    def wrap(self, name, **kwargs):
+        """The text before and after the placeholder name, to put content
+        that is written in chunks between them"""
+        head, tail = self.format.split("%%(%s)s" % name, 1)
+        return head % kwargs, tail % kwargs
+
+
+class TemplateRegistry(object):
+    """Every template in a directory, read and compiled the first time one
+    of them is needed. In reload mode a template is compiled again when its
+    file changes, which is handy while working on them."""
+
+    def __init__(self, directory, reload=False):
+        self.directory = directory
+        self.reload = reload
+        self.templates = None
+
+    def path(self, name):
+        return pjoin(self.directory, "%s.tpl" % name)
+
+    def compile(self, path):
+        mtime = os.path.getmtime(path)
+        with open(path) as fp:
+            return mtime, CompiledTemplate(fp.read())
+
+    def load(self):
+        self.templates = {}
+        for path in glob.glob(self.path("*")):
+            name = bname(path)[:-len(".tpl")]
+            self.templates[name] = self.compile(path)
+
+    def get(self, name):
+        if self.templates is None:
+            self.load()
+
+        try:
+            mtime, template = self.templates[name]
+        except KeyError:
+            # Not there when the registry was loaded
+            mtime, template = self.templates[name] = self.compile(
+                self.path(name))
+            return template
+
+        if self.reload:
+            path = self.path(name)
+            if os.path.getmtime(path) != mtime:
+                mtime, template = self.templates[name] = self.compile(path)
+
+        return template
+
+
+templates = TemplateRegistry("templates")
 
 
 def load_template(template):
-    fp = open("templates/%s.tpl" % (template, ))
-    out = Template(''.join(fp.readlines()))
-    fp.close()
-    return out
+    return templates.get(template)
 
 
 def get_pagination(prev_page=None, next_page=None):
@@ -143,6 +177,87 @@ def strip_tags(html):
     return s.get_data()
 
 
+# Extensions of compressed pages (foo.1.gz) and how to read each of them as
+# a stream. Without an lzma module .xz pages are recognized but unsupported.
+COMPRESSIONS = {'.gz', '.bz2', '.xz'}
+
+DECOMPRESSORS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.BZ2File,
+}
+
+if lzma:
+    DECOMPRESSORS['.xz'] = lzma.LZMAFile
+
+
+def page_name(path):
+    """(name, section, compression) of a page file, e.g. ('ls', '1', '.gz')
+    for ls.1.gz. compression is empty for plain pages."""
+    name, ext = os.path.splitext(os.path.basename(path))
+
+    compression = ''
+    if ext in COMPRESSIONS:
+        compression = ext
+        name, ext = os.path.splitext(name)
+
+    return name, ext[1:], compression
+
+
+def open_page(path, buffering=-1):
+    """Opens a page for reading, decompressing it on the fly if needed"""
+    _, _, compression = page_name(path)
+    if not compression:
+        return open(path, 'rb', buffering)
+
+    return DECOMPRESSORS[compression](path)
+
+
+def find_page(path):
+    """The file of the page at path, plain or compressed. Redirections name
+    plain pages, their targets may have been shipped compressed."""
+    if os.path.exists(path):
+        return path
+
+    for compression in COMPRESSIONS:
+        if os.path.exists(path + compression):
+            return path + compression
+
+    return path
+
+
+def file_hash(path):
+    with open(path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def chunks(items, size=None):
+    """Lists of size items taken one after another from an iterable, or a
+    single list of all of them when size is None"""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+
+        yield chunk
+
+
+# Stored trees start with it, bump it when the node classes change shape
+TREE_FORMAT = "T2:"
+
+
+def dump_tree(tree):
+    return TREE_FORMAT + zlib.compress(
+        cPickle.dumps(tree, cPickle.HIGHEST_PROTOCOL), 1)
+
+
+def load_tree(data):
+    if data[:len(TREE_FORMAT)] != TREE_FORMAT:
+        raise ValueError("Tree stored in an older format")
+
+    return cPickle.loads(zlib.decompress(data[len(TREE_FORMAT):]))
+
+
 pjoin = os.path.join
 dname = os.path.dirname
 bname = os.path.basename
@@ -153,6 +268,49 @@ bname = os.path.basename
 linkifier = re.compile(
     r"(?P<pretag><\w+?>)?(?P<page>\w+[\w\.-]+\w+)(?P<posttag></\w+?>)?[(](?P<section>\d)[)]")
 
+# Escapes resolved by unescape. Adding a glyph only needs a new entry, the
+# longest sequence wins when several of them match.
+ESCAPES = {
+    "\\*(dg": "(!)",
+    "\\{": "{",
+    "\\\\0": "&#92;0",
+    "\\-": "-",
+    "\\ ": "&nbsp;",
+    "\\0": "&nbsp;",
+    "\\%": "",
+    "\\:": "",
+    "\\|": "",  # Narrow spaces
+    "\\^": "",
+    "\\(bu": "&bull;",
+    "\\`": "&#96;",  # Backtick
+    "\\\\": "&#92;",
+    "\\[char46]": "&#46;",
+    "\\(co": "&copy;",
+    "\\(em": "&ndash;",
+    "\\(en": "&ndash;",
+    "\\(dq": "&quot;",
+    "\\(aq": "&apos;",
+    "\\*(Aq": "&apos;",
+    "\\(+-": "&plusmn;",
+    "\\(:A": "&Auml;",
+    "\\('a": "&aacute;",
+    "\\(`a": "&agrave;",
+    "\\(:a": "&auml;",
+    "\\(^a": "&acirc;",
+    "\\(12": "&frac12;",
+    "\\.": ".",
+    "\\(mc": "&micro;",
+    "\\*(lq": "&ldquo;",
+    "\\(lq": "&ldquo;",
+    "\\*(rq": "&rdquo;",
+    "\\(rq": "&rdquo;",
+    "\\e": "&#92;",
+    "\\&": "",
+}
+
+unescaper = re.compile('|'.join(
+    re.escape(escape) for escape in sorted(ESCAPES, key=len, reverse=True)))
+
 SECTIONS = {
     'man1': "Executable programs or shell commands",
     'man2': "System calls",
@@ -166,6 +324,163 @@ SECTIONS = {
 }
 
 
+# Font escapes (\\fX) and the style they switch to
+FONT_TRANSLATION = {
+    '1': 'R',
+    '2': 'I',
+    '3': 'B',
+    '4': 'B',
+    'b': 'B',
+    'r': 'R',
+    'p': 'P',
+    'i': 'I',
+    'L': 'B',
+    'l': 'I',
+}
+
+FONT_STYLES = {
+    'L': "strong",
+    'B': "strong",
+    'I': "em",
+    'SM': "small",
+    'S': "small",
+}
+
+FONT_OPEN = {style: "<%s>" % tag for style, tag in FONT_STYLES.items()}
+FONT_CLOSE = {style: "</%s>" % tag for style, tag in FONT_STYLES.items()}
+
+# Only short arguments (option names and the like) repeat across pages. The
+# cache is simply emptied when it fills up, which keeps lookups cheap.
+FONT_CACHE_MAX_LENGTH = 64
+FONT_CACHE_SIZE = 100000
+font_cache = dict()
+
+
+def render_fonts(content, current_tag):
+    """Turns font escapes into html tags, starting with current_tag (None or
+    one of FONT_STYLES). Text between backslashes is copied in bulk, only
+    the escapes themselves are looked at one by one."""
+    previous_tag = None
+    out = [FONT_OPEN[current_tag]] if current_tag else []
+
+    position, end = 0, len(content)
+    while position < end:
+        slash = content.find('\\', position)
+        if slash == -1:
+            out.append(content[position:])
+            break
+
+        out.append(content[position:slash])
+
+        c = content[slash + 1:slash + 2]
+        if c != 'f':
+            # A trailing backslash is dropped
+            out.append('\\' + c if c else '')
+            position = slash + 2
+            continue
+
+        c = content[slash + 2:slash + 3]
+        position = slash + 3
+
+        while c == '[':
+            closing = content.find(']', position)
+            if closing == -1:
+                # Unfinished font name, drop the rest
+                c, position = '', end
+                break
+
+            # Only the last character of the name counts
+            c = content[closing - 1] if closing > position else 'R'
+            position = closing + 1
+
+        c = FONT_TRANSLATION.get(c, c)
+        if c in FONT_STYLES:
+            if current_tag:
+                out.append(FONT_CLOSE[current_tag])
+
+            previous_tag, current_tag = current_tag, c
+            out.append(FONT_OPEN[c])
+        elif c == 'P':
+            if current_tag:
+                out.append(FONT_CLOSE[current_tag])
+            previous_tag, current_tag = current_tag, previous_tag
+
+            if current_tag:
+                out.append(FONT_OPEN[current_tag])
+        elif c == 'R':
+            if current_tag:
+                out.append(FONT_CLOSE[current_tag])
+            previous_tag, current_tag = current_tag, None
+        elif c in {'$', 'C', '7', 'N'}:
+            # So many bugs...
+            pass
+        elif c == '(':
+            name = content[position:position + 2]
+            position += 2
+
+            if name[:1] not in {'', 'C', 'B'}:
+                raise Exception()
+            elif len(name) < 2 or name in {'CW', 'Cw'}:
+                pass
+            elif name in {'CB', 'CO', 'CI', 'BI'}:
+                if current_tag:
+                    out.append(FONT_CLOSE[current_tag])
+
+                previous_tag, current_tag = current_tag, "B"
+                out.append(FONT_OPEN["B"])
+            else:
+                raise Exception()
+        else:
+            out.append(c)
+
+    if current_tag:
+        out.append(FONT_CLOSE[current_tag])
+
+    return ''.join(out)
+
+
+# Column keys of a tbl format line. Everything else is a modifier of the
+# column before it (font, width, spacing...) or a vertical line.
+TBL_KEYS = frozenset("lrcnas^_-=LRCNAS")
+
+
+def tbl_columns(format_line):
+    """Number of columns in a tbl format line, e.g. 3 for 'lB lw(2i) n.'
+    Rows of keys separated with commas are counted on their own and the
+    widest one wins."""
+    columns, widest = 0, 0
+    position, end = 0, len(format_line)
+    while position < end:
+        c = format_line[position]
+        position += 1
+
+        if c in TBL_KEYS:
+            columns += 1
+        elif c == ',':
+            widest, columns = max(widest, columns), 0
+        elif c == '.':
+            break
+        elif c == '(':
+            # Arguments like w(2.5i)
+            closing = format_line.find(')', position)
+            position = end if closing == -1 else closing + 1
+        elif c in 'fF':
+            # Font: fB, f(CW or f[CW]
+            if format_line[position:position + 1] == '(':
+                position += 3
+            elif format_line[position:position + 1] == '[':
+                closing = format_line.find(']', position)
+                position = end if closing == -1 else closing + 1
+            else:
+                position += 1
+        elif c in 'pPvV':
+            # Point size and vertical spacing, with an optional sign
+            if format_line[position:position + 1] in {'+', '-'}:
+                position += 1
+
+    return max(widest, columns)
+
+
 class Macro(object):
     single_style = {'B', 'I', 'SM', 'L'}
     compound_style = {'BI', 'BR', 'IR', 'RI', 'RB', 'IB', 'SB', 'LR'}
@@ -239,6 +554,19 @@ class Macro(object):
 
     new_paragraph = {'PP', 'P', 'LP'}
 
+    # Macros opening a nested block, and the parser handling it
+    blocks = {
+        'RS': 'RS-RE',
+        'SS': 'SUBSECTION',
+        'nf': 'PRE',
+        'EX': 'EXAMPLE',
+        'TS': 'TABLE',
+        'TP': 'TP',
+        'IP': 'IP',
+        'MT': 'MAILTO',
+        'UR': 'URL',
+    }
+
     style_tpl = {
         "SM": Template("<small>${content}</small>"),
         "S": Template("<small>${content}</small>"),
@@ -249,133 +577,31 @@ class Macro(object):
 
     @staticmethod
     def process_fonts(content, current_tag=None):
-        #print content, current_tag
-
         if current_tag in {'R'}:
             current_tag = None
 
-        translate_font = {
-            '1': 'R',
-            '2': 'I',
-            '3': 'B',
-            '4': 'B',
-            'b': 'B',
-            'r': 'R',
-            'p': 'P',
-            'i': 'I',
-            'L': 'B',
-            'l': 'I',
-        }
-
-        style_map = {
-            'L': "strong",
-            'B': "strong",
-            'I': "em",
-            'SM': "small",
-            'S': "small",
-        }
-
-        previous_tag = None
-        if not current_tag:
-            out = ""
-        elif current_tag in style_map:
-            out = "<%s>" % style_map[current_tag]
-        else:
+        if current_tag and current_tag not in FONT_STYLES:
             raise Exception("Current tag %s" % current_tag)
 
-        state = "start"
-        for c in content:
-            if state == "start":
-                if c != '\\':
-                    out += c
-                elif c == '\\':
-                    state = "slash"
-            elif state == "slash":
-                if c == 'f':
-                    state = "fontslash"
-                else:
-                    state = "start"
-                    out += '\\' + c
-            elif state in {"fontslash", "fontsquare"}:
-                if state == "fontsquare":
-                    if c != ']':
-                        tmp_tag = c
-                        continue
-                    else:
-                        if not tmp_tag:
-                            tmp_tag = "R"
-
-                        c = tmp_tag
-
-                if c in translate_font:
-                    c = translate_font[c]
-                if c in style_map:
-                    if current_tag:
-                        out += "</%s>" % style_map[current_tag]
-
-                    previous_tag, current_tag = current_tag, c
-                    out += "<%s>" % style_map[c]
-                    state = "start"
-                elif c in {'P'}:
-                    if current_tag:
-                        out += "</%s>" % style_map[current_tag]
-                    previous_tag, current_tag = current_tag, previous_tag
-
-                    if current_tag:
-                        out += "<%s>" % style_map[current_tag]
-
-                    state = "start"
-                elif c in {'R'}:
-                    if current_tag:
-                        out += "</%s>" % style_map[current_tag]
-                    previous_tag, current_tag = current_tag, None
-                    state = "start"
-                elif c in {'$', 'C', '7', 'N'}:
-                    # So many bugs...
-                    state = "start"
-                elif c in {'('}:
-                    state = "fontparentheses"
-                elif c in {'['}:
-                    tmp_tag = None
-                    state = "fontsquare"
-                else:
-                    state = "start"
-                    out += c
-            elif state == "fontparentheses":
-                if c == "C":
-                    state = "fontparentheses1"
-                elif c == "B":
-                    state = "fontparentheses2"
-                else:
-                    raise Exception()
-            elif state == "fontparentheses1":
-                if c in {"W", "w"}:
-                    state = "start"
-                elif c in {"B", "O", "I"}:
-                    if current_tag:
-                        out += "</%s>" % style_map[current_tag]
-
-                    previous_tag, current_tag = current_tag, "B"
-
-                    out += "<%s>" % style_map["B"]
-                    state = "start"
-                else:
-                    raise Exception()
-            elif state == "fontparentheses2":
-                if c == "I":
-                    if current_tag:
-                        out += "</%s>" % style_map[current_tag]
-
-                    previous_tag, current_tag = current_tag, "B"
-
-                    out += "<%s>" % style_map["B"]
-                    state = "start"
-                else:
-                    raise Exception()
-        else:
-            if current_tag:
-                out += "</%s>" % style_map[current_tag]
+        if '\\' not in content:
+            if not current_tag:
+                return content
 
+            return FONT_OPEN[current_tag] + content + FONT_CLOSE[current_tag]
+
+        if len(content) > FONT_CACHE_MAX_LENGTH:
+            return render_fonts(content, current_tag)
+
+        key = (content, current_tag)
+        try:
+            return font_cache[key]
+        except KeyError:
+            pass
+
+        if len(font_cache) >= FONT_CACHE_SIZE:
+            font_cache.clear()
+
+        out = font_cache[key] = render_fonts(content, current_tag)
         return out
 
     @staticmethod
@@ -404,27 +630,6 @@ def entitize(line):
     return line.replace("<", "&lt;").replace(">", "&gt;")
 
 
-@lru_cache(maxsize=100000)
-def toargs(data):
-    def tokenize():
-        lexer = shlex.shlex(data, posix=True)
-        lexer.commenters = ''
-        lexer.quotes = "\""
-        lexer.whitespace_split = True
-        return list(lexer)
-
-    try:
-        args = tokenize()
-    except:
-        data += "\""
-        try:
-            args = tokenize()
-        except:
-            raise
-
-    return args
-
-
 def unescape(t):
     if not t:
         return t
@@ -432,54 +637,4 @@ def unescape(t):
     if "\\" not in t:
         return t
 
-    t = t.replace("\\*(dg", "(!)")
-
-    t = t.replace("\{", "{")
-
-    t = t.replace("\\\\0", "&#92;0")
-
-    t = t.replace("\-", "-")
-    t = t.replace("\ ", "&nbsp;")
-    t = t.replace("\\0", "&nbsp;")
-
-    t = t.replace("\%", "")
-    t = t.replace("\:", "")
-
-    t = t.replace("\\(bu", "&bull;")
-
-    t = t.replace("\`", "&#96;")  # Backtick
-
-    t = t.replace("\\\\", "&#92;")
-
-    t = t.replace("\[char46]", "&#46;")
-
-    t = t.replace("\\(co", "&copy;")
-
-    t = t.replace("\\(em", "&ndash;")
-    t = t.replace("\\(en", "&ndash;")
-
-    t = t.replace("\\(dq", "&quot;")
-    t = t.replace("\\(aq", "&apos;")
-    t = t.replace("\\*(Aq", "&apos;")
-
-    t = t.replace("\\(+-", "&plusmn;")
-
-    t = t.replace("\\(:A", "&Auml;")
-
-    t = t.replace("\\('a", "&aacute;")
-    t = t.replace("\\(`a", "&agrave;")
-    t = t.replace("\\(:a", "&auml;")
-    t = t.replace("\\(^a", "&acirc;")
-
-    t = t.replace("\\(12", "&frac12;")
-    t = t.replace("\\.", ".")
-    t = t.replace("\\(mc", "&micro;")
-
-    t = t.replace("\\*(lq", "&ldquo;").replace("\\(lq", "&ldquo;")
-    t = t.replace("\\*(rq", "&rdquo;").replace("\\(rq", "&rdquo;")
-
-    t = t.replace("\\e", "&#92;")
-
-    t = t.replace("\&", "")
-
-    return t
+    return unescaper.sub(lambda m: ESCAPES[m.group(0)], t)
@@ -0,0 +1,229 @@
+"""Man page references, like ls(1), and the pages they link to"""
+
+import os
+import mmap
+import zlib
+import struct
+import sqlite3
+from collections import Counter
+from repoze.lru import LRUCache
+
+from helpers import linkifier
+
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+
+class LinkTargets(object):
+    """An immutable set of page names (name.section) kept in a file that is
+    read through mmap, so rendering processes share the same pages of
+    memory instead of unpickling a copy each. After a header the file has
+    an open addressing hash table (crc32, linear probing) with the offsets
+    of the names, and then the names, sorted and one per line."""
+
+    magic = "LNK1"
+    header = struct.Struct("<4sII")  # magic, names, slots
+    slot = struct.Struct("<I")  # offset of the name + 1, 0 when empty
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.length, slots = LinkTargets.header.unpack_from(self.data)
+        if magic != LinkTargets.magic:
+            raise ValueError("%s is not a link targets file" % path)
+
+        self.mask = slots - 1
+        self.table = LinkTargets.header.size
+        self.names = self.table + slots * LinkTargets.slot.size
+
+    @staticmethod
+    def build(path, names):
+        names = sorted(set(names))
+
+        slots = 1
+        while slots < 2 * len(names):
+            slots *= 2
+
+        mask = slots - 1
+        table = [0] * slots
+        offset = 0
+        for name in names:
+            i = zlib.crc32(name) & mask
+            while table[i]:
+                i = (i + 1) & mask
+
+            table[i] = offset + 1
+            offset += len(name) + 1
+
+        # Readers that already have the previous file mapped keep it
+        temporary = path + ".tmp"
+        with open(temporary, 'wb') as fp:
+            fp.write(LinkTargets.header.pack(LinkTargets.magic, len(names),
+                                             slots))
+            fp.write(struct.pack("<%sI" % slots, *table))
+            for name in names:
+                fp.write(name + "\n")
+
+        os.rename(temporary, path)
+
+    def __contains__(self, name):
+        data, mask = self.data, self.mask
+        key = name + "\n"
+        i = zlib.crc32(name) & mask
+        while True:
+            offset, = LinkTargets.slot.unpack_from(data, self.table + i * 4)
+            if not offset:
+                return False
+
+            start = self.names + offset - 1
+            if data[start:start + len(key)] == key:
+                return True
+
+            i = (i + 1) & mask
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.data[self.names:].splitlines())
+
+    def __getstate__(self):
+        # Other processes map the file again
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+
+class PageLookup(object):
+    """The page names (name.section) of the catalog of a database, looked up
+    one at a time through its index instead of being loaded. The latest
+    answers are kept in a small LRU cache, as pages link to the same few
+    pages over and over. Memory does not grow with the catalog."""
+
+    cache_size = 4096
+
+    query = "SELECT 1 FROM catalog WHERE name = ? AND section = ? LIMIT 1"
+
+    def __init__(self, database):
+        self.database = database
+        self.owner = None
+        self.cache = LRUCache(PageLookup.cache_size)
+        self.length = self.connection.execute(
+            "SELECT count(*) FROM (SELECT DISTINCT name, section FROM catalog)"
+        ).fetchone()[0]
+
+    @property
+    def connection(self):
+        if self.owner != os.getpid():
+            # Forked workers can not use the connection of their parent
+            self.conn = sqlite3.connect(self.database)
+            self.conn.text_factory = str
+            self.owner = os.getpid()
+
+        return self.conn
+
+    def __contains__(self, page):
+        found = self.cache.get(page)
+        if found is None:
+            name, _, section = page.rpartition('.')
+            rows = self.connection.execute(PageLookup.query, (name, section))
+            found = rows.fetchone() is not None
+            self.cache.put(page, found)
+
+        return found
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        # Other processes open the database again
+        return self.database
+
+    def __setstate__(self, database):
+        self.__init__(database)
+
+
+class LinkResolver(object):
+    """Turns the references in a fragment of html into links to the pages
+    of a generate run (a set, LinkTargets or PageLookup of name.section).
+    Whole fragments are memoized, as the same SEE ALSO lists show up in
+    thousands of pages."""
+
+    # A reference always ends like (1), text without it is left alone
+    prescan = re.compile(r"[(]\d[)]")
+
+    memo_max_length = 1024
+    memo_size = 50000
+
+    def __init__(self, pages, memo_size=None):
+        self.pages = pages
+        self.memo = dict()
+        self.memo_size = memo_size or LinkResolver.memo_size
+        self.stats = Counter()
+
+    def resolve(self, page):
+        """The page (name.section) a reference links to, None if missing.
+        That is the page with the exact name or, failing that, the
+        lowercase one."""
+        if page in self.pages:
+            return page
+
+        page = page.lower()
+        if page in self.pages:
+            return page
+
+        return None
+
+    def linkify(self, item):
+        """Returns the fragment with links and the (page, target) of every
+        reference in it"""
+        if not self.pages or not self.prescan.search(item):
+            self.stats['skipped'] += 1
+            return item, ()
+
+        memoize = len(item) <= LinkResolver.memo_max_length
+        if memoize:
+            try:
+                out = self.memo[item]
+                self.stats['hits'] += 1
+                return out
+            except KeyError:
+                pass
+
+        self.stats['misses'] += 1
+        references = []
+
+        def repl(m):
+            manpage, section, pretag, posttag = m.group(
+                'page', 'section', 'pretag', 'posttag')
+
+            page = "%s.%s" % (manpage, section)
+            target = self.resolve(page)
+            references.append((page, target))
+
+            if posttag and not pretag:
+                append = posttag
+            else:
+                append = ""
+
+            out = "<strong>%s</strong>(%s)" % (manpage, section, )
+            if target is None:
+                return out + append
+
+            return "<a href=\"../man%s/%s.html\">%s</a>%s" % (section, target,
+                                                              out, append, )
+
+        out = linkifier.sub(repl, item), tuple(references)
+
+        if memoize:
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+
+            self.memo[item] = out
+
+        return out
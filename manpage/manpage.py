@@ -1,9 +1,10 @@
-from helpers import load_template, get_breadcrumb, strip_tags, linkifier, unescape
+from helpers import load_template, get_breadcrumb, strip_tags, unescape
 from helpers import get_pagination, unescape
 from cached_property import cached_property
 from helpers import SECTIONS
 from collections import Counter
-from helpers import Macro
+from helpers import Macro, tbl_columns
+from profiling import timer
 try:
     import re2 as re
 except ImportError:
@@ -11,66 +12,37 @@ except ImportError:
 
 
 def linkify(item):
-    if not AvailablePages.pages:
+    resolver = AvailablePages.resolver
+    if resolver is None:
         return item
 
-    must_appear = {'(', ')'}
-    if not all(x in item for x in must_appear):
-        # Speed optimization
-        return item
-
-    def repl(m):
-        manpage = m.groupdict()['page']
-        section = m.groupdict()['section']
-
-        page = '.'.join([manpage, section])
+    if timer.enabled:
+        with timer.stage("linkify"):
+            out, references = resolver.linkify(item)
+    else:
+        out, references = resolver.linkify(item)
 
-        pretag = m.groupdict()['pretag']
-        posttag = m.groupdict()['posttag']
+    for page, target in references:
+        if AvailablePages.requested is not None:
+            AvailablePages.requested.add(page)
 
-        if posttag and not pretag:
-            append = posttag
-        else:
-            append = ""
-
-        if page in AvailablePages.pages:
-            out = "<strong>%s</strong>(%s)" % (manpage,
-                                               section, )
-            out = "<a href=\"../man%s/%s.%s.html\">%s</a>%s" % (section,
-                                                                manpage,
-                                                                section,
-                                                                out,
-                                                                append, )
-        elif page.lower() in AvailablePages.pages:
-            out = "<strong>%s</strong>(%s)" % (manpage,
-                                               section, )
-            out = "<a href=\"../man%s/%s.%s.html\">%s</a>%s" % (
-                section,
-                manpage.lower(),
-                section,
-                out,
-                append, )
-        else:
-            out = "<strong>%s</strong>(%s)%s" % (manpage,
-                                                 section,
-                                                 append, )
+        if target is None:
             AvailablePages.unavailable[page] += 1
 
-        return out
-
-    return linkifier.sub(repl, item)
+    return out
 
 
 class AvailablePages(object):
-    pages = None
+    resolver = None
     unavailable = Counter()
-
-
-class AvailableSections(object):
-    titles = Counter()
+    requested = None
 
 
 class BaseContainer(object):
+    """A node of the page tree. Nodes have slots instead of a __dict__, as
+    there are thousands of them in a page and trees are kept around."""
+    __slots__ = ('contents', )
+
     def __init__(self):
         self.contents = []
 
@@ -84,8 +56,12 @@ class BaseContainer(object):
         self.contents.insert(0, object)
 
     def html(self):
+        return ''.join(self.chunks())
+
+    def chunks(self):
+        """The html in pieces, every block as soon as it is rendered, so
+        it can be written out without holding the whole page"""
         p_tpl = load_template('p')
-        out = []
         strings = []
         for item in self.contents:
             if isinstance(item, str):
@@ -93,93 +69,123 @@ class BaseContainer(object):
                     if strings:
                         content = linkify(' '.join(strings))
                         strings = []
-                        out.append(p_tpl.substitute(content=content))
+                        yield p_tpl.substitute(content=content)
                 else:
                     strings.append(item)
             else:
                 if strings:
                     content = linkify(' '.join(strings))
                     strings = []
-                    out.append(p_tpl.substitute(content=content))
+                    yield p_tpl.substitute(content=content)
 
-                out.append(item.html())
+                for chunk in item.chunks():
+                    yield chunk
         else:
             if strings:
                 content = linkify(' '.join(strings))
                 strings = []
-                out.append(p_tpl.substitute(content=content))
-
-        return ''.join(out)
+                yield p_tpl.substitute(content=content)
 
 
 class Container(BaseContainer):
-    pass
+    __slots__ = ()
 
 
 class Table(BaseContainer):
-    def html(self):
-        # FIXME: At some point we need to rewrite this. screen.1 contains
-        # some problems
-        state = 0
-        cells = []
+    """A tbl table, its contents are the lines between TS and TE"""
+    __slots__ = ()
+
+    def rows(self):
+        """Cells of every row, read in a single pass over the lines: the
+        options (for tab(x)) and format lines first, and then the data,
+        where T{ and T} enclose a text block that may span several lines.
+        Rows are padded to the columns of the format."""
         splitter = '\t'
+        columns = None
+        row, block = [], None
         for line in self.contents:
-            row = line.split(splitter)
-            if state == 0 and row[-1].endswith('.'):
-                columns = len(row[0].split())
-                state = 2
-            elif state == 0 and 'tab(' in row[0]:
-                splitter = row[0].split('tab(')[1].split(')')[0]
-            elif state == 2:
-                if len(row) == 1 and row[0] == '_':
-                    pass
-                else:
-                    if 'T{' not in line and 'T}' not in line:
-                        while len(row) < columns:
-                            row.append('')
-                    cells.extend(row)
-
-        try:
-            while True:
-                s, e = cells.index('T{'), cells.index('T}')
-                cells[s:e + 1] = [' '.join(cells[s + 1:e])]
-        except:
-            pass
-
-        out = ""
-        first = True
-        while cells:
-            out += "\n<tr>"
-            for cell in cells[0:columns]:
-                cell = cell.replace("\\0", "")
-                if first:
-                    out += "\n<th>%s</th>" % linkify(cell)
-                else:
-                    out += "\n<td>%s</td>" % linkify(cell)
-            del cells[0:columns]
-            first = False
-            out += "</tr>\n"
-        out = "<table class=\"table table-striped\">%s</table>" % out
+            if columns is None:
+                fields = line.split(splitter)
+                if fields[-1].endswith('.'):
+                    columns = max(tbl_columns(line), 1)
+                elif 'tab(' in fields[0]:
+                    splitter = fields[0].split('tab(')[1].split(')')[0]
+
+                continue
+
+            if block is not None:
+                if not line.startswith('T}'):
+                    block.append(line)
+                    continue
+
+                # The row goes on after the block
+                row.append(' '.join(block))
+                block = None
+                fields = line[2:].split(splitter)[1:]
+            elif line in {'_', '='}:
+                # Horizontal rules
+                continue
+            else:
+                fields = line.split(splitter)
+
+            for i, field in enumerate(fields):
+                if field == 'T{':
+                    block = fields[i + 1:]
+                    break
+
+                row.append(field)
+
+            if block is None:
+                yield row + [''] * (columns - len(row))
+                row = []
+
+        if block is not None:
+            # Unfinished text block
+            row.append(' '.join(block))
+
+        if row:
+            yield row + [''] * (columns - len(row))
+
+    def chunks(self):
+        yield "<table class=\"table table-striped\">"
+        cell_tpl = "\n<th>%s</th>"
+        for row in self.rows():
+            out = ["\n<tr>"]
+            for cell in row:
+                out.append(cell_tpl % linkify(cell.replace("\\0", "")))
 
-        return out
+            out.append("</tr>\n")
+            cell_tpl = "\n<td>%s</td>"
+            yield ''.join(out)
+
+        yield "</table>"
 
 
 class Section(BaseContainer):
     """docstring for Section"""
-    tpl = load_template('section')
+    __slots__ = ('title', )
 
     def __init__(self):
         super(Section, self).__init__()
         self.title = None
 
-    def html(self):
-        out = super(Section, self).html()
+    def template(self):
+        # Loaded on every render, so --reload-templates sees changes
+        return load_template('section')
+
+    def chunks(self):
+        head, tail = self.template().wrap('content',
+                                          title=linkify(self.title))
 
-        return self.tpl.substitute(title=linkify(self.title), content=out)
+        yield head
+        for chunk in super(Section, self).chunks():
+            yield chunk
+        yield tail
 
 
 class Manpage(BaseContainer):
     """docstring for Manpage"""
+    # No slots, cached_property needs a __dict__ and there is one per page
 
     def __init__(self, name, section):
         super(Manpage, self).__init__()
@@ -187,6 +193,7 @@ class Manpage(BaseContainer):
         self.section = section
 
         self.title = None
+        self.section_titles = []
 
         self.package = None
         self.prev_page = None
@@ -224,7 +231,7 @@ class Manpage(BaseContainer):
         self.contents = filter(self.process_sections, self.contents)
 
     def process_sections(self, section):
-        AvailableSections.titles[section.title] += 1
+        self.section_titles.append(section.title)
 
         if section.title == 'NAME':
             try:
@@ -288,9 +295,11 @@ class Manpage(BaseContainer):
 
         return '\n'.join(breadcrumbs)
 
-    def html(self):
-        content = super(Manpage, self).html()
+    def write(self, fp):
+        """Writes the page to fp as it is rendered"""
+        fp.writelines(self.chunks())
 
+    def chunks(self):
         if self.url and self.package:
             twitter_headers = load_template('twitter-card').substitute(
                 title="%s (%s) manual" % (self.name,
@@ -309,24 +318,32 @@ class Manpage(BaseContainer):
         else:
             extraheaders = ""
 
-        return load_template('base').substitute(
+        head, tail = load_template('base').wrap(
+            'content',
             breadcrumb=self.breadcrumbs,
             title=self.descriptive_title,
             extraheaders=extraheaders,
             metadescription=self.title,
-            header=self.page_header,
-            content=content + self.pager_contents, )
+            header=self.page_header, )
+
+        yield head
+        for chunk in super(Manpage, self).chunks():
+            yield chunk
+        yield self.pager_contents
+        yield tail
 
 
 class IndentedBlock(BaseContainer):
-    pass
+    __slots__ = ()
 
 
 class PreformattedBlock(BaseContainer):
-    def html(self):
+    __slots__ = ()
+
+    def chunks(self):
         content = '\n'.join([linkify(item) for item in self.contents])
 
-        return load_template('pre').substitute(content=content)
+        yield load_template('pre').substitute(content=content)
 
     def append(self, object):
         if not self.contents and not object.strip():
@@ -336,16 +353,24 @@ class PreformattedBlock(BaseContainer):
 
 
 class SpacedBlock(BaseContainer):
-    def html(self):
+    __slots__ = ()
+
+    def chunks(self):
         out = [linkify(item) for item in self.contents]
-        return load_template('pre').substitute(content='\n'.join(out))
+        yield load_template('pre').substitute(content='\n'.join(out))
 
 
 class SubSection(Section):
-    tpl = load_template('subsection')
+    __slots__ = ()
+
+    def template(self):
+        return load_template('subsection')
 
 
 class DefinitionList(BaseContainer):
+    """Its contents are (bullets, items) containers"""
+    __slots__ = ('next_is_bullet', )
+
     def __init__(self):
         super(DefinitionList, self).__init__()
         self.next_is_bullet = False
@@ -357,17 +382,21 @@ class DefinitionList(BaseContainer):
         else:
             self.contents[-1][1].append(object)
 
-    def html(self):
+    def chunks(self):
         dtdd_tpl = load_template('dtdd')
-        dl_tpl = load_template('dl')
+        head, tail = load_template('dl').wrap('content')
 
-        out = [dtdd_tpl.substitute(
-            bullet=bullets.html(), content=items.html())
-               for bullets, items in self.contents]
-        return dl_tpl.substitute(content=''.join(out))
+        yield head
+        for bullets, items in self.contents:
+            dt, dd = dtdd_tpl.wrap('content', bullet=bullets.html())
+            yield dt
+            for chunk in items.chunks():
+                yield chunk
+            yield dd
+        yield tail
 
     def add_bullet(self):
-        self.contents.append([Container(), Container()])
+        self.contents.append((Container(), Container()))
         self.expect_bullet()
 
     def expect_bullet(self):
@@ -375,14 +404,17 @@ class DefinitionList(BaseContainer):
 
 
 class Mailto(BaseContainer):
-    pass
+    __slots__ = ()
 
 
 class Url(BaseContainer):
-    pass
+    __slots__ = ()
 
 
 class BulletedList(BaseContainer):
+    """Its contents are (bullet, items), the bullet being html"""
+    __slots__ = ()
+
     def append(self, object):
         self.contents[-1][1].append(object)
 
@@ -394,31 +426,36 @@ class BulletedList(BaseContainer):
         else:
             bullet = Macro.process_fonts(unescape(args[0]))
 
-        self.contents.append([bullet, Container()])
+        self.contents.append((intern(bullet), Container()))
 
-    def html(self):
+    def chunks(self):
         bullets = set([bullet for bullet, _ in self.contents])
         n_bullets = len(bullets)
 
         if not n_bullets:
-            return ""
+            return
         elif n_bullets == 1 and len(list(bullets)[0]) < 2:
-            ul_tpl = load_template('ul')
+            # UL
+            head, tail = load_template('ul').wrap('content')
             li_tpl = load_template('li')
 
-            out = [li_tpl.substitute(content=items.html())
-                   for _, items in self.contents]
-
-            return ul_tpl.substitute(content=''.join(out))
-            # UL
+            yield head
+            for _, items in self.contents:
+                li, li_end = li_tpl.wrap('content')
+                yield li
+                for chunk in items.chunks():
+                    yield chunk
+                yield li_end
+            yield tail
         else:
             dtdd_tpl = load_template('dtdd')
-            dl_tpl = load_template('dl')
+            head, tail = load_template('dl').wrap('content')
 
-            out = []
+            yield head
             for bullet, items in self.contents:
-                out.append(
-                    dtdd_tpl.substitute(
-                        bullet=bullet, content=items.html()))
-
-            return dl_tpl.substitute(content=''.join(out))
+                dt, dd = dtdd_tpl.wrap('content', bullet=bullet)
+                yield dt
+                for chunk in items.chunks():
+                    yield chunk
+                yield dd
+            yield tail
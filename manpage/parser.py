@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 """Man Page Parse Module"""
 
+import sys
 import time
 import logging
 import argparse
-import os.path
+from collections import deque
 
 from helpers import unescape, entitize
-from helpers import consume, tokenize
+from helpers import tokenize
+from helpers import page_name, open_page, DECOMPRESSORS
 from string import Template
 
 from manpage import Manpage, Section, SubSection, BulletedList, DefinitionList
@@ -22,6 +24,12 @@ except ImportError:
     import re
 
 
+# Stored with every outcome and tree dirparse keeps, and part of the inputs
+# of every rendered page. Bump it with any change to the parser, or to the
+# helpers it uses like unescape, that changes the trees of some pages.
+PARSER_VERSION = 1
+
+
 class Line(object):
     cc = '.'
     c2 = '\''
@@ -30,7 +38,27 @@ class Line(object):
     comment = ec + '"'
 
 
+# What process_line wants done with the current line, besides returning a
+# new Block to open
+NEXT_LINE = 0  # The line has been consumed
+CLOSE = 1  # The line has been consumed and closes the current block
+CLOSE_BEFORE = 2  # The current block ends before the line
+
+
+class Block(object):
+    """A block being built by process_man7, one per nesting level"""
+    __slots__ = ('parser', 'content')
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.content = None
+
+
 class CustomMacros(object):
+    # An argument in a macro body: \\$1 to \\$9, \\$* or \\$@ (pages also
+    # write them with a single backslash)
+    argument = re.compile(r'\\\\?\$([1-9*@])')
+
     def __init__(self):
         self.macros = dict()
         self.current_macro = None
@@ -43,6 +71,25 @@ class CustomMacros(object):
         self.macros[macro] = []
         self.current_macro = macro
 
+    def expand(self, macro, rest):
+        """The body of a macro with the arguments of a call in place. \\$*
+        is every argument, \\$@ every argument quoted."""
+        args = tokenize(rest)
+
+        def repl(m):
+            argument = m.group(1)
+            if argument == '*':
+                return ' '.join(args)
+            elif argument == '@':
+                return ' '.join('"%s"' % arg.replace('"', '""')
+                                for arg in args)
+
+            position = int(argument) - 1
+            return args[position] if position < len(args) else ''
+
+        return [CustomMacros.argument.sub(repl, line)
+                for line in self.macros[macro]]
+
 
 class RedirectedPage(Exception):
     def __init__(self, page, redirect):
@@ -68,30 +115,80 @@ class NotSupportedFormat(Exception):
         super(NotSupportedFormat, self).__init__(message)
 
 
-class FileMacroIterator(object):
-    def __init__(self, fp):
-        self.lines = fp.readlines()
-        self.current = 0
-        self.high = len(self.lines)
-        self.buffered_lines = []
+class MalformedPage(Exception):
+    def __init__(self, reason, file=""):
+        message = "Malformed page (%s) in file (%s)" % (reason, file, )
+        self.reason = reason
 
-    def __iter__(self):
-        return self
+        super(MalformedPage, self).__init__(message)
 
-    def __next__(self):  # Compatibility with python 3
-        return self.next()
 
-    def next(self):
-        if self.buffered_lines:
-            return self.buffered_lines.pop(0)
-        elif self.current == self.high:
-            raise StopIteration
-        else:
-            self.current += 1
-            return self.lines[self.current - 1]
+class LineLexer(object):
+    """Logical lines of a page, read as a stream: fixed by fix (if given),
+    comments removed and continuation lines (ending in \\ or \\c) joined.
+    Physical lines come from a stack of sources, the page at the bottom and
+    the bodies of the custom macros being expanded on top of it, so a macro
+    invoked from another one gives way back to its caller when done."""
+
+    max_depth = 64
 
-    def add_lines(self, lines):
-        self.buffered_lines = lines
+    def __init__(self, fp, fix=None):
+        self.sources = deque([iter(fp)])
+        self.fix = fix
+
+    def push(self, lines):
+        if len(self.sources) > LineLexer.max_depth:
+            raise MalformedPage("custom macros nested too deep")
+
+        self.sources.append(iter(lines))
+
+    def next_raw(self):
+        """Next physical line, as it is. Raises StopIteration at the end"""
+        sources = self.sources
+        while True:
+            line = next(sources[-1], None)
+            if line is not None:
+                return line
+            elif len(sources) == 1:
+                raise StopIteration
+
+            sources.pop()
+
+    def __iter__(self):
+        sources = self.sources
+        fix = self.fix
+        extra = []
+        while True:
+            line = next(sources[-1], None)
+            if line is None:
+                if len(sources) == 1:
+                    break
+
+                sources.pop()
+                continue
+
+            line = line.rstrip()
+            if fix is not None:
+                line = fix(line)
+
+            if Line.comment in line:
+                line = line.split(Line.comment, 1)[0]
+
+            if len(line) > 2:
+                if line[-1] == "\\":
+                    if line[-2] != "\\" and line[-2] != "{":
+                        extra.append(line[:-1])
+                        continue
+                elif line[-2:] == "\\c":
+                    extra.append(line[:-2])
+                    continue
+
+            if extra:
+                extra.append(line)
+                line = ' '.join(extra)
+                extra = []
+
+            yield line
 
 
 class ManpageParser(object):
@@ -117,12 +214,10 @@ class ManpageParser(object):
         r'#!/usr/bin/perl',
     }
 
-    def __init__(self, path):
-        basename = os.path.basename(path)
-
-        self.name, ext = os.path.splitext(basename)
+    read_buffer = 1 << 16
 
-        self.numeric_section = ext[1:]
+    def __init__(self, path):
+        self.name, self.numeric_section, self.compression = page_name(path)
         self._path = path
         self.lines = []
         self.parser = None
@@ -147,40 +242,26 @@ class ManpageParser(object):
         """ self.path property """
         return self._path
 
-    def readfile(self):
-        with open(self.path) as fp:
-            extra = []
-            iterator = FileMacroIterator(fp)
-            for line in iterator:
-                line = line.rstrip()
-
-                if line in ManpageParser.forbidden_lines:
-                    raise NotSupportedFormat(self.path)
-
-                # Fix buggy lines
-                line = ManpageParser.line_replacement.get(line, line)
-
-                for k,v in ManpageParser.str_replacement:
-                    line = line.replace(k, v)
-
-                if Line.comment in line:
-                    # Line has comment
-                    line = line.split(Line.comment, 1)[0]
-
-                if line and len(line) > 2:
-                    if line[-1] == "\\":
-                        if line[-2] != "\\" and line[-2] != "{":
-                            extra.append(line[:-1])
-                            continue
-                    elif line[-2:] == "\\c":
-                        extra.append(line[:-2])
-                        continue
+    def fix_line(self, line):
+        if line in ManpageParser.forbidden_lines:
+            raise NotSupportedFormat(self.path)
+
+        # Fix buggy lines
+        line = ManpageParser.line_replacement.get(line, line)
+
+        if "\\f" in line:
+            for k, v in ManpageParser.str_replacement:
+                line = line.replace(k, v)
 
-                if extra:
-                    extra.append(line)
-                    line = ' '.join(extra)
-                    extra = []
+        return line
 
+    def readfile(self):
+        if self.compression and self.compression not in DECOMPRESSORS:
+            raise NotSupportedFormat(self.path)
+
+        with open_page(self.path, ManpageParser.read_buffer) as fp:
+            lexer = LineLexer(fp, self.fix_line)
+            for line in lexer:
                 if line == Line.cc or line == Line.c2 or line == '\'.':
                     # Empty line (cc or c2)
                     continue
@@ -207,15 +288,15 @@ class ManpageParser(object):
                         # Bug in devlink-sb.8
                         macro = 'B'
 
-                    if macro in self.custom_macros.macros:
-                        iterator.add_lines(self.custom_macros.macros[macro])
-                        continue
-
                     if len(chunks) == 2:
                         rest = chunks[1]
                     else:
                         rest = ""
 
+                    if macro in self.custom_macros.macros:
+                        lexer.push(self.custom_macros.expand(macro, rest))
+                        continue
+
                     if macro == 'so':
                         raise RedirectedPage(self.path, rest)
 
@@ -236,7 +317,7 @@ class ManpageParser(object):
                             braces -= 1
 
                         while braces:
-                            macro_line = next(iterator)
+                            macro_line = lexer.next_raw()
                             if "\\{" in macro_line:
                                 braces += 1
 
@@ -256,7 +337,7 @@ class ManpageParser(object):
 
                     if macro == 'ig':
                         while True:
-                            macro_line = next(iterator)
+                            macro_line = lexer.next_raw()
                             if macro_line.rstrip().startswith(".."):
                                 break
 
@@ -265,7 +346,7 @@ class ManpageParser(object):
                     if macro in {'de', 'de1'}:
                         self.custom_macros.add_macro(rest.strip())
                         while True:
-                            macro_line = next(iterator)
+                            macro_line = lexer.next_raw()
                             if macro_line.rstrip().startswith(".."):
                                 break
                             else:
@@ -284,7 +365,8 @@ class ManpageParser(object):
                     if macro in Macro.vertical_spacing:
                         self.lines.append(('', ''))
                     else:
-                        self.lines.append((macro, tokenize(entitize(rest))))
+                        self.lines.append((intern(macro),
+                                           tokenize(entitize(rest))))
                 else:
                     self.lines.append(('', entitize(line)))
 
@@ -296,250 +378,239 @@ class ManpageParser(object):
 
         return self.parser(self, *args, **kwargs)
 
-    def process_man7(self, start=0, parser="ROOT"):
-        content = None
-        iter = enumerate(self.lines[start:])
-        for i, (macro, args) in iter:
-            logging.debug("LINE (CP: %s): (%s: %s) [%s]", parser, macro, args,
-                          repr(content))
-
-            if parser == "ROOT":
-                if not content:
-                    content = Manpage(
-                        name=self.name, section=self.numeric_section)
-
-                # ROOT
-                if macro == 'TH':
-                    continue  # FIXME
-                elif macro == 'SH':
-                    inc, section_content = self.process(start + i, 'SECTION')
-                    content.append(section_content)
-                    consume(iter, inc)
-                    continue
-                elif macro == 'SS':
-                    inc, section_content = self.process(start + i,
-                                                        'SS-SECTION')
-                    content.append(section_content)
-                    consume(iter, inc)
-                    continue
-                elif macro:
-                    raise UnexpectedMacro(parser, macro, args, self.path)
-                elif not macro:
-                    continue
+    def process_man7(self):
+        """Builds the page tree in a single pass over self.lines. Every
+        nested block gets a Block on the stack, and process_line decides
+        what the innermost one does with each line."""
+        trace = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        lines = self.lines
+        stack = [Block("ROOT")]
+        block = stack[-1]
+
+        i, high = 0, len(lines)
+        while i < high:
+            macro, args = lines[i]
+            if trace:
+                logging.debug("LINE (CP: %s): (%s: %s) [%s]", block.parser,
+                              macro, args, repr(block.content))
+
+            action = self.process_line(block, macro, args)
+
+            if action == NEXT_LINE:
+                i += 1
+            elif action == CLOSE or action == CLOSE_BEFORE:
+                stack.pop()
+                stack[-1].content.append(block.content)
+                block = stack[-1]
+
+                if action == CLOSE:
+                    i += 1
             else:
-                if macro in Macro.styles:
-                    args = Macro.stylize(macro, args)
-                    macro = ''
-                elif macro in {'CW', 'R', 'nop'}:
-                    macro = ''
-                    args = ' '.join(args)
-
-                if parser == 'SECTION':
-                    if macro == 'SH':
-                        if content is None:
-                            content = Section()
-                            content.title = unescape(' '.join(args))
-                            continue
-                        else:
-                            return i - 1, content
-                    elif macro in {'RS', 'IP'} and content.title == "NAME":
-                        # Very nasty bug in yum-copr.8
-                        continue
-                    elif macro in {'RE', 'fi'}:
-                        # Plenty of pages with bugs
-                        continue
-                if parser == 'SS-SECTION':
-                    if macro == 'SS':
-                        if content is None:
-                            content = Section()
-                            content.title = unescape(' '.join(args))
-                            continue
-                        else:
-                            return i - 1, content
-                    elif macro in {'RE', 'fi'}:
-                        # Plenty of pages with bugs
-                        continue
-                elif parser == 'SUBSECTION':
-                    if macro == 'SS':
-                        if content is None:
-                            content = SubSection()
-                            content.title = unescape(' '.join(args))
-                            continue
-                        else:
-                            return i - 1, content
-                    elif macro == 'SH':
-                        return i - 1, content
-                    elif macro in {'RE'}:
-                        # This is to fix a bug in proc.5 FIXME
-                        continue
-                elif parser == 'RS-RE':
-                    if content is None:
-                        content = IndentedBlock()
-                        continue
-
-                    if macro == 'RE':
-                        return i, content
-                    elif macro in {'SH', 'SS'}:
-                        return i - 1, content
-                    elif macro in {'fi'}:
-                        # This is to fix a bug in proc.5 FIXME
-                        return i - 1, content
-                elif parser == 'EXAMPLE':
-                    if content is None:
-                        content = PreformattedBlock()
-                        continue
-
-                    if macro == 'EE':
-                        return i, content
-                    elif macro in {'nf', 'fi'}:
-                        continue
-                    elif macro:
-                        raise UnexpectedMacro(parser, macro, args, self.path)
-                elif parser == 'PRE':
-                    if content is None:
-                        content = PreformattedBlock()
-                        continue
-
-                    if macro == 'fi':
-                        return i, content
-                    elif macro in {'SH', 'SS', 'RE'}:
-                        return i - 1, content
-                    elif macro in Macro.new_paragraph:
-                        pass
-                    elif macro in {'RS', 'TP', 'IP', 'nf'}:
-                        # This is to fix a bug in proc.5 and many others
-                        continue
-                    elif macro:
-                        raise UnexpectedMacro(parser, macro, args, self.path)
-                elif parser == 'TP':
-                    if content is None:
-                        content = DefinitionList()
-
-                    if macro == 'TP':
-                        content.add_bullet()
-                        continue
-                    elif macro == 'TQ':
-                        content.expect_bullet()
-                        continue
-                    elif macro in {'SH', 'SS', 'RE'}:
-                        return i - 1, content
-                    elif macro in {'IP', 'RS', 'nf', 'TS', 'UR', 'EX'}:
-                        pass
-                    elif macro in {'fi'}:
-                        continue
-                    elif macro in Macro.new_paragraph:
-                        return i - 1, content
-                    elif macro:
-                        raise UnexpectedMacro(parser, macro, args, self.path)
-                elif parser == 'IP':
-                    if content is None:
-                        content = BulletedList()
-
-                    if macro == 'IP':
-                        content.add_bullet(args)
-                        continue
-                    elif macro in {'SH', 'SS', 'RE'}:
-                        return i - 1, content
-                    elif macro in Macro.new_paragraph:
-                        return i - 1, content
-                    elif macro == 'TP':
-                        return i - 1, content
-                    elif macro in {'RS', 'nf', 'TS', 'UR'}:
-                        pass
-                    elif macro:
-                        raise UnexpectedMacro(parser, macro, args, self.path)
-                elif parser == 'TABLE':
-                    if content is None:
-                        content = Table()
-                        continue
-
-                    if macro == 'TE':
-                        return i, content
-                    elif macro in {'nf', 'fi', 'IP'}:
-                        # Errors, errors...
-                        continue
-                elif parser == 'MAILTO':
-                    # FIXME: Missing processor
-                    if content is None:
-                        content = Mailto()
-                        continue
-
-                    if macro == 'ME':
-                        return i, content
-                elif parser == 'URL':
-                    # FIXME: Missing processor
-                    if content is None:
-                        content = Url()
-                        continue
-
-                    if macro == 'UE':
-                        return i, content
-                elif parser == 'SPACEDBLOCK':
-                    if content is None:
-                        content = SpacedBlock()
-
-                    if not macro and args.startswith('  '):
-                        content.append(Macro.process_fonts(unescape(args)))
-                        continue
-                    else:
-                        return i - 1, content
-
-                if not macro:
-                    if args.startswith('  ') and parser not in {
-                            'PRE', 'EXAMPLE', 'TABLE'
-                    }:
-                        inc, spaced_content = self.process(start + i,
-                                                           'SPACEDBLOCK')
-                        content.append(spaced_content)
-                        consume(iter, inc)
-                    else:
-                        content.append(Macro.process_fonts(unescape(args)))
-                elif macro in Macro.new_paragraph:
-                    content.append('')
-                elif macro == 'RS':
-                    inc, rs_content = self.process(start + i, 'RS-RE')
-                    content.append(rs_content)
-                    consume(iter, inc)
-                elif macro == 'SS':
-                    inc, ss_content = self.process(start + i, 'SUBSECTION')
-                    content.append(ss_content)
-                    consume(iter, inc)
-                elif macro == 'nf':
-                    inc, nf_content = self.process(start + i, 'PRE')
-                    content.append(nf_content)
-                    consume(iter, inc)
-                elif macro == 'EX':
-                    inc, ex_content = self.process(start + i, 'EXAMPLE')
-                    content.append(ex_content)
-                    consume(iter, inc)
-                elif macro == 'TS':
-                    inc, table_content = self.process(start + i, 'TABLE')
-                    content.append(table_content)
-                    consume(iter, inc)
-                elif macro == 'TP':
-                    inc, tp_content = self.process(start + i, 'TP')
-                    content.append(tp_content)
-                    consume(iter, inc)
-                elif macro == 'IP':
-                    inc, ip_content = self.process(start + i, 'IP')
-                    content.append(ip_content)
-                    consume(iter, inc)
-                elif macro == 'MT':
-                    inc, mt_content = self.process(start + i, 'MAILTO')
-                    content.append(mt_content)
-                    consume(iter, inc)
-                elif macro == 'UR':
-                    inc, ur_content = self.process(start + i, 'URL')
-                    content.append(ur_content)
-                    consume(iter, inc)
+                # A new block starts at this very line
+                stack.append(action)
+                block = action
+
+        while len(stack) > 1:
+            block = stack.pop()
+            stack[-1].content.append(block.content)
+
+        content = stack[0].content
+        content.pre_process()
+        return content
+
+    def process_line(self, block, macro, args):
+        parser, content = block.parser, block.content
+
+        if parser == "ROOT":
+            if content is None:
+                block.content = Manpage(
+                    name=self.name, section=self.numeric_section)
+
+            # ROOT
+            if macro == 'TH':
+                return NEXT_LINE  # FIXME
+            elif macro == 'SH':
+                return Block('SECTION')
+            elif macro == 'SS':
+                return Block('SS-SECTION')
+            elif macro:
+                raise UnexpectedMacro(parser, macro, args, self.path)
+            else:
+                return NEXT_LINE
+
+        if macro in Macro.styles:
+            args = Macro.stylize(macro, args)
+            macro = ''
+        elif macro in {'CW', 'R', 'nop'}:
+            macro = ''
+            args = ' '.join(args)
+
+        if parser == 'SECTION':
+            if macro == 'SH':
+                if content is None:
+                    block.content = Section()
+                    block.content.title = intern(unescape(' '.join(args)))
+                    return NEXT_LINE
+                else:
+                    return CLOSE_BEFORE
+            elif macro in {'RS', 'IP'} and content.title == "NAME":
+                # Very nasty bug in yum-copr.8
+                return NEXT_LINE
+            elif macro in {'RE', 'fi'}:
+                # Plenty of pages with bugs
+                return NEXT_LINE
+        elif parser == 'SS-SECTION':
+            if macro == 'SS':
+                if content is None:
+                    block.content = Section()
+                    block.content.title = intern(unescape(' '.join(args)))
+                    return NEXT_LINE
                 else:
-                    raise UnexpectedMacro(parser, macro, args, self.path)
+                    return CLOSE_BEFORE
+            elif macro in {'RE', 'fi'}:
+                # Plenty of pages with bugs
+                return NEXT_LINE
+        elif parser == 'SUBSECTION':
+            if macro == 'SS':
+                if content is None:
+                    block.content = SubSection()
+                    block.content.title = intern(unescape(' '.join(args)))
+                    return NEXT_LINE
+                else:
+                    return CLOSE_BEFORE
+            elif macro == 'SH':
+                return CLOSE_BEFORE
+            elif macro in {'RE'}:
+                # This is to fix a bug in proc.5 FIXME
+                return NEXT_LINE
+        elif parser == 'RS-RE':
+            if content is None:
+                block.content = IndentedBlock()
+                return NEXT_LINE
+
+            if macro == 'RE':
+                return CLOSE
+            elif macro in {'SH', 'SS'}:
+                return CLOSE_BEFORE
+            elif macro in {'fi'}:
+                # This is to fix a bug in proc.5 FIXME
+                return CLOSE_BEFORE
+        elif parser == 'EXAMPLE':
+            if content is None:
+                block.content = PreformattedBlock()
+                return NEXT_LINE
+
+            if macro == 'EE':
+                return CLOSE
+            elif macro in {'nf', 'fi'}:
+                return NEXT_LINE
+            elif macro:
+                raise UnexpectedMacro(parser, macro, args, self.path)
+        elif parser == 'PRE':
+            if content is None:
+                block.content = PreformattedBlock()
+                return NEXT_LINE
+
+            if macro == 'fi':
+                return CLOSE
+            elif macro in {'SH', 'SS', 'RE'}:
+                return CLOSE_BEFORE
+            elif macro in Macro.new_paragraph:
+                pass
+            elif macro in {'RS', 'TP', 'IP', 'nf'}:
+                # This is to fix a bug in proc.5 and many others
+                return NEXT_LINE
+            elif macro:
+                raise UnexpectedMacro(parser, macro, args, self.path)
+        elif parser == 'TP':
+            if content is None:
+                block.content = content = DefinitionList()
+
+            if macro == 'TP':
+                content.add_bullet()
+                return NEXT_LINE
+            elif macro == 'TQ':
+                content.expect_bullet()
+                return NEXT_LINE
+            elif macro in {'SH', 'SS', 'RE'}:
+                return CLOSE_BEFORE
+            elif macro in {'IP', 'RS', 'nf', 'TS', 'UR', 'EX'}:
+                pass
+            elif macro in {'fi'}:
+                return NEXT_LINE
+            elif macro in Macro.new_paragraph:
+                return CLOSE_BEFORE
+            elif macro:
+                raise UnexpectedMacro(parser, macro, args, self.path)
+        elif parser == 'IP':
+            if content is None:
+                block.content = content = BulletedList()
+
+            if macro == 'IP':
+                content.add_bullet(args)
+                return NEXT_LINE
+            elif macro in {'SH', 'SS', 'RE'}:
+                return CLOSE_BEFORE
+            elif macro in Macro.new_paragraph:
+                return CLOSE_BEFORE
+            elif macro == 'TP':
+                return CLOSE_BEFORE
+            elif macro in {'RS', 'nf', 'TS', 'UR'}:
+                pass
+            elif macro:
+                raise UnexpectedMacro(parser, macro, args, self.path)
+        elif parser == 'TABLE':
+            if content is None:
+                block.content = Table()
+                return NEXT_LINE
+
+            if macro == 'TE':
+                return CLOSE
+            elif macro in {'nf', 'fi', 'IP'}:
+                # Errors, errors...
+                return NEXT_LINE
+        elif parser == 'MAILTO':
+            # FIXME: Missing processor
+            if content is None:
+                block.content = Mailto()
+                return NEXT_LINE
+
+            if macro == 'ME':
+                return CLOSE
+        elif parser == 'URL':
+            # FIXME: Missing processor
+            if content is None:
+                block.content = Url()
+                return NEXT_LINE
+
+            if macro == 'UE':
+                return CLOSE
+        elif parser == 'SPACEDBLOCK':
+            if content is None:
+                block.content = content = SpacedBlock()
+
+            if not macro and args.startswith('  '):
+                content.append(Macro.process_fonts(unescape(args)))
+                return NEXT_LINE
+            else:
+                return CLOSE_BEFORE
+
+        if not macro:
+            if args.startswith('  ') and parser not in {
+                    'PRE', 'EXAMPLE', 'TABLE'
+            }:
+                return Block('SPACEDBLOCK')
+            else:
+                content.append(Macro.process_fonts(unescape(args)))
+        elif macro in Macro.new_paragraph:
+            content.append('')
+        elif macro in Macro.blocks:
+            return Block(Macro.blocks[macro])
         else:
-            if parser == 'ROOT':
-                content.pre_process()
-                return content
+            raise UnexpectedMacro(parser, macro, args, self.path)
 
-            return None, content
+        return NEXT_LINE
 
 
 def main():
@@ -562,11 +633,10 @@ def main():
     parsed = manpage.process()
 
     if args.out_file:
-        fp = open(args.out_file, 'w')
-        fp.write(parsed.html())
-        fp.close()
+        with open(args.out_file, 'w') as fp:
+            parsed.write(fp)
     else:
-        print parsed.html()
+        parsed.write(sys.stdout)
 
     elapsed = time.time() - start_time
     logging.info("--- Total time: %s seconds ---", elapsed)
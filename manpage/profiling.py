@@ -0,0 +1,207 @@
+"""Wall time of every page of a run, split by stage, and timelines of
+builds"""
+
+import os
+import json
+import time
+from collections import Counter
+from functools import wraps
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """Records how long each stage (lex, parse, linkify, write...) takes
+    for every page. Stages nest and record their own time only: a linkify
+    inside template substitution is not counted twice. Does nothing until
+    enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.pages = dict()  # page -> [size, Counter of seconds per stage]
+        self.stages = []
+        self.current = None
+        self.frames = []
+        self.last = None
+
+    def start_page(self, page):
+        if not self.enabled:
+            return
+
+        self.current = self.pages.setdefault(page, [0, Counter()])
+        self.frames = []
+        self.last = time.time()
+
+    def lap(self, name):
+        """Counts the time since the page started or the last lap as a
+        stage, for code that goes through its stages one after another"""
+        if not self.enabled or self.current is None:
+            return
+
+        now = time.time()
+        self.add(name, now - self.last)
+        self.last = now
+
+    def page_size(self, size):
+        if self.enabled and self.current is not None:
+            self.current[0] = size
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled or self.current is None:
+            yield
+            return
+
+        # Time spent in nested stages, taken out of this one
+        frame = [0]
+        self.frames.append(frame)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.frames.pop()
+            if self.frames:
+                self.frames[-1][0] += elapsed
+
+            self.add(name, elapsed - frame[0])
+
+    def add(self, name, seconds):
+        if name not in self.stages:
+            self.stages.append(name)
+
+        self.current[1][name] += seconds
+
+    def take(self):
+        """The stages and pages recorded so far, forgetting the pages"""
+        pages = self.pages
+        self.pages, self.current = dict(), None
+        return list(self.stages), pages
+
+    def merge(self, taken):
+        stages, pages = taken
+        for name in stages:
+            if name not in self.stages:
+                self.stages.append(name)
+
+        for page, (size, times) in pages.iteritems():
+            known = self.pages.setdefault(page, [0, Counter()])
+            known[0] = size or known[0]
+            known[1].update(times)
+
+    def report(self, amount):
+        if not self.pages:
+            print "No pages were timed"
+            return
+
+        totals = Counter()
+        for _, times in self.pages.itervalues():
+            totals.update(times)
+
+        print "Time by stage over %d pages: %s" % (len(self.pages), ", ".join(
+            "%s %.2fs" % (name, totals[name]) for name in self.stages))
+
+        slowest = sorted(self.pages.iteritems(),
+                         key=lambda item: sum(item[1][1].values()),
+                         reverse=True)[:amount]
+
+        print "Slowest %d pages:" % len(slowest)
+        print "%-50s %8s %10s  %s" % ("page", "KB", "total ms", " ".join(
+            "%10s" % name for name in self.stages))
+        for page, (size, times) in slowest:
+            print "%-50s %8.1f %10.1f  %s" % (
+                page, size / 1024.0, sum(times.values()) * 1000, " ".join(
+                    "%10.1f" % (times[name] * 1000) for name in self.stages))
+
+
+class Tracer(object):
+    """Spans of the phases of a build and of every page, saved as a Chrome
+    trace-event file (chrome://tracing, ui.perfetto.dev). Each process is a
+    track of its own. Does nothing until enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.named = set()
+        # Workers are forked later on
+        self.main = self.owner = os.getpid()
+
+    @contextmanager
+    def span(self, name, category="phase", **args):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.time(), args)
+
+    def add(self, name, category, start, end, args):
+        pid = os.getpid()
+        if pid != self.owner:
+            # A forked worker, the events it inherited are the parent's
+            self.events, self.owner = [], pid
+
+        if pid not in self.named:
+            label = "main" if pid == self.main else "worker %d" % pid
+            self.named.add(pid)
+            self.events.append({"name": "process_name", "ph": "M",
+                                "pid": pid, "tid": pid,
+                                "args": {"name": label}})
+
+        self.events.append({"name": name, "cat": category, "ph": "X",
+                            "ts": int(start * 1e6),
+                            "dur": int((end - start) * 1e6),
+                            "pid": pid, "tid": pid, "args": args})
+
+    def take(self):
+        """The events recorded so far, forgetting them"""
+        events, self.events = self.events, []
+        return events
+
+    def merge(self, events):
+        self.events.extend(events)
+
+    def save(self, path):
+        with open(path, 'w') as fp:
+            json.dump({"traceEvents": self.events,
+                       "displayTimeUnit": "ms"}, fp)
+
+
+timer = StageTimer()
+tracer = Tracer()
+
+
+def traced(func):
+    """Makes every call of func a span of the trace"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracer.span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def profiled(call):
+    """Runs func(item) in a worker process and hands back, along with the
+    result, the times and spans it recorded"""
+    func, item = call
+    return func(item), timer.take(), tracer.take()
+
+
+def merged(results):
+    for result, taken, events in results:
+        timer.merge(taken)
+        tracer.merge(events)
+        yield result
+
+
+def worker_imap(imap, func, items, **kwargs):
+    """imap (of a Pool) of func over items. When timing or tracing, what
+    the workers recorded is merged into this process."""
+    if not timer.enabled and not tracer.enabled:
+        return imap(func, items, **kwargs)
+
+    calls = ((func, item) for item in items)
+    return merged(imap(profiled, calls, **kwargs))
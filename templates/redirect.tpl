@@ -0,0 +1,12 @@
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>${url}</title>
+  <link rel="canonical" href="${url}">
+  <meta http-equiv="refresh" content="0; url=${url}">
+</head>
+<body>
+  <a href="${url}">${url}</a>
+</body>
+</html>
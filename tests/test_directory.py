@@ -0,0 +1,535 @@
+"""Checks of dirparse on copies of pages of benchmarks/corpus"""
+
+import os
+import glob
+import gzip
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from manpage import directory
+from manpage.directory import ManDirectoryParser, resolve_redirects
+
+CORPUS = "benchmarks/corpus"
+
+
+def patch(test, owner, name, value):
+    """Sets an attribute of owner for the length of the test"""
+    test.addCleanup(setattr, owner, name, getattr(owner, name))
+    setattr(owner, name, value)
+
+
+def parsed_pages(test):
+    """The list of the files parse_page is called on during the test"""
+    parsed = []
+    parse_page = directory.parse_page
+
+    def recording_parse_page(page_file):
+        parsed.append(page_file)
+        return parse_page(page_file)
+
+    patch(test, directory, "parse_page", recording_parse_page)
+    return parsed
+
+
+class DuplicatePagesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, "src")
+        self.page = os.path.join(self.source_dir, "coreutils", "ls.1")
+        shutil.copytree(os.path.join(CORPUS, "coreutils"),
+                        os.path.dirname(self.page))
+
+        # A fetch of a newer coreutils next to the page of the last one
+        with open(self.page, 'rb') as plain:
+            with gzip.open(self.page + ".gz", 'wb') as compressed:
+                compressed.write(plain.read())
+
+        os.utime(self.page, (1000000000, 1000000000))
+
+        database = os.path.join(self.tmp, "manpages.db")
+        shutil.copy("base.db", database)
+        self.parser = ManDirectoryParser(database=database)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def ls_files(self):
+        query = "SELECT file FROM manpages WHERE name = 'ls'"
+        return [row[0] for row in self.parser.conn.execute(query)]
+
+    def test_newest_file_is_kept(self):
+        self.parser.parse_directory(self.source_dir)
+        self.assertEqual(self.ls_files(), [self.page + ".gz"])
+
+    def test_plain_file_is_kept_when_as_old(self):
+        os.utime(self.page + ".gz", (1000000000, 1000000000))
+        self.parser.parse_directory(self.source_dir, jobs=2)
+        self.assertEqual(self.ls_files(), [self.page])
+
+
+class GenerateCountersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp, "manpages.db")
+        self.output_dir = os.path.join(self.tmp, "public_html")
+        shutil.copy("base.db", self.database)
+        ManDirectoryParser(database=self.database).parse_directory(CORPUS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def generate(self):
+        parser = ManDirectoryParser(database=self.database)
+        parser.generate_output(self.output_dir, "https://www.carta.tech/")
+        return parser.missing_links, parser.section_counters
+
+    def test_counters_of_a_run_with_nothing_to_render(self):
+        missing_links, section_counters = self.generate()
+        self.assertTrue(missing_links)
+        self.assertEqual(section_counters["NAME"], 8)
+
+        self.assertEqual(self.generate(), (missing_links, section_counters))
+
+
+class ParserVersionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp, "manpages.db")
+        shutil.copy("base.db", self.database)
+        self.parser = ManDirectoryParser(database=self.database)
+        self.parser.parse_directory(CORPUS)
+        self.parser.generate_output(os.path.join(self.tmp, "public_html"),
+                                    "https://www.carta.tech/")
+
+        self.parsed = parsed_pages(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def sources(self):
+        query = "SELECT count(*) FROM sources"
+        return self.parser.conn.execute(query).fetchone()[0]
+
+    def test_same_version_is_not_parsed_again(self):
+        self.parser.parse_directory(CORPUS)
+        self.assertEqual(self.parsed, [])
+        self.assertEqual(list(self.parser.pages_to_render()), [])
+
+    def test_older_outcomes_are_parsed_again(self):
+        self.parser.conn.execute("UPDATE sources SET parser = NULL")
+        self.parser.parse_directory(CORPUS)
+        self.assertEqual(len(self.parsed), self.sources())
+
+    def test_new_version_parses_and_renders_again(self):
+        patch(self, directory, "PARSER_VERSION", directory.PARSER_VERSION + 1)
+        self.parser.parse_directory(CORPUS)
+        self.assertEqual(len(self.parsed), self.sources())
+
+        catalog = self.parser.conn.execute("SELECT count(*) FROM catalog")
+        self.assertEqual(len(list(self.parser.pages_to_render())),
+                         catalog.fetchone()[0])
+
+    def test_older_trees_are_not_loaded(self):
+        page_file = os.path.join(CORPUS, "coreutils", "ls.1")
+        # The tree of another page, as a tree from an older parser may be
+        self.parser.conn.execute("""UPDATE parsed_pages SET parser = NULL,
+            tree = (SELECT tree FROM parsed_pages WHERE file LIKE '%tput.1')
+            WHERE file = ?""", (page_file, ))
+        self.assertEqual(self.parser.load_manpage(page_file).name, "ls")
+
+
+class IncrementalTest(unittest.TestCase):
+    """A copy of benchmarks/corpus, parsed once"""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, "src")
+        shutil.copytree(CORPUS, self.source_dir)
+        self.tput = os.path.join(self.source_dir, "ncurses-bin", "tput.1")
+
+        # A page with a link to tput(1)
+        with open(os.path.join(self.source_dir, "ncurses-bin", "clear.1"),
+                  'w') as fp:
+            fp.write(".TH CLEAR 1\n.SH NAME\nclear \\- clear the screen\n"
+                     ".SH SEE ALSO\ntput(1)\n")
+
+        self.database = os.path.join(self.tmp, "manpages.db")
+        shutil.copy("base.db", self.database)
+        self.dirparse()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def dirparse(self, full=False):
+        self.parser = ManDirectoryParser(database=self.database)
+        self.parser.parse_directory(self.source_dir, full=full)
+
+    def rows(self, query):
+        return [row[0] for row in self.parser.conn.execute(query)]
+
+
+class IncrementalDirparseTest(IncrementalTest):
+    def setUp(self):
+        super(IncrementalDirparseTest, self).setUp()
+        self.parsed = parsed_pages(self)
+
+    def test_unchanged_sources_are_not_parsed(self):
+        self.dirparse()
+        self.assertEqual(self.parsed, [])
+
+    def test_touched_source_is_not_parsed(self):
+        os.utime(self.tput, (1000000000, 1000000000))
+        self.dirparse()
+        self.assertEqual(self.parsed, [])
+        self.assertEqual(
+            self.rows("SELECT mtime FROM sources WHERE file LIKE '%/tput.1'"),
+            [1000000000])
+
+    def test_edited_source_is_parsed(self):
+        with open(self.tput, 'a') as fp:
+            fp.write(".PP\nOne more paragraph.\n")
+
+        self.dirparse()
+        self.assertEqual(self.parsed, [self.tput])
+
+    def test_deleted_source_is_forgotten(self):
+        os.remove(self.tput)
+        self.dirparse()
+        self.assertEqual(self.parsed, [])
+        self.assertNotIn("tput", self.rows("SELECT name FROM manpages"))
+        self.assertNotIn("tput", self.rows("SELECT name FROM catalog"))
+        for table in ("sources", "parsed_pages"):
+            self.assertNotIn(self.tput,
+                             self.rows("SELECT file FROM %s" % table))
+
+    def test_full_parses_every_source(self):
+        self.dirparse(full=True)
+        self.assertEqual(sorted(self.parsed),
+                         sorted(glob.glob("%s/*/*.*" % self.source_dir)))
+
+
+
+class IncrementalGenerateTest(IncrementalTest):
+    def setUp(self):
+        super(IncrementalGenerateTest, self).setUp()
+        self.output_dir = os.path.join(self.tmp, "public_html")
+        self.generate()
+
+        self.rendered = []
+        write_page = ManDirectoryParser.__dict__["write_page"]
+
+        def recording_write_page(parser, **page):
+            self.rendered.append(page["name"])
+            return write_page(parser, **page)
+
+        patch(self, ManDirectoryParser, "write_page", recording_write_page)
+
+    def generate(self, full=False):
+        self.dirparse(full)
+        self.parser.generate_output(self.output_dir,
+                                    "https://www.carta.tech/", full=full)
+
+    def output(self, path):
+        return os.path.join(self.output_dir, "man-pages", path)
+
+    def test_unchanged_pages_are_not_rendered(self):
+        self.generate()
+        self.assertEqual(self.rendered, [])
+
+    def test_edited_page_is_rendered(self):
+        with open(self.tput, 'a') as fp:
+            fp.write(".PP\nOne more paragraph.\n")
+
+        self.generate()
+        # The link of clear.1 goes to the same page as before
+        self.assertEqual(self.rendered, ["tput"])
+        with open(self.output("man1/tput.1.html")) as fp:
+            self.assertIn("One more paragraph.", fp.read())
+
+    def test_deleted_page_is_removed(self):
+        os.remove(self.tput)
+        self.generate()
+        self.assertFalse(os.path.exists(self.output("man1/tput.1.html")))
+        self.assertNotIn("man1/tput.1.html",
+                         self.rows("SELECT path FROM rendered_pages"))
+
+        # clear.1 links to it, tar.1 was the page before it
+        self.assertEqual(sorted(self.rendered), ["clear", "tar"])
+
+    def test_full_renders_every_page(self):
+        self.generate(full=True)
+        self.assertEqual(sorted(self.rendered),
+                         sorted(self.rows("SELECT name FROM catalog")))
+
+
+
+class ResolveRedirectsTest(unittest.TestCase):
+    def test_redirect(self):
+        self.assertEqual(resolve_redirects({"dir.1": "ls.1"}),
+                         {"dir.1": "ls.1"})
+
+    def test_chains(self):
+        redirects = {"a.1": "b.1", "b.1": "c.1", "c.1": "ls.1", "d.1": "b.1"}
+        self.assertEqual(resolve_redirects(redirects),
+                         dict.fromkeys(redirects, "ls.1"))
+
+    def test_loops(self):
+        redirects = {"a.1": "b.1", "b.1": "a.1", "c.1": "a.1", "d.1": "d.1",
+                     "e.1": "ls.1"}
+        self.assertEqual(resolve_redirects(redirects),
+                         {"a.1": None, "b.1": None, "c.1": None, "d.1": None,
+                          "e.1": "ls.1"})
+
+    def test_missing_targets_are_kept(self):
+        # Whether the target exists is up to the outcome of the target
+        self.assertEqual(resolve_redirects({"a.1": "b.1", "b.1": "gone.1"}),
+                         {"a.1": "gone.1", "b.1": "gone.1"})
+
+
+class RedirectedPagesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, "src")
+        self.coreutils = os.path.join(self.source_dir, "coreutils")
+        shutil.copytree(os.path.join(CORPUS, "coreutils"), self.coreutils)
+
+        # .so lines go from the directory of the sources
+        for stub, redirect in (("dir.1", "coreutils/ls.1"),
+                               ("vdir.1", "dir.1"),
+                               ("loop.1", "coreutils/loop.8"),
+                               ("loop.8", "loop.1"),
+                               ("gone.1", "coreutils/nothere.1")):
+            with open(os.path.join(self.coreutils, stub), 'w') as fp:
+                fp.write(".so %s\n" % redirect)
+
+        database = os.path.join(self.tmp, "manpages.db")
+        shutil.copy("base.db", database)
+        self.parser = ManDirectoryParser(database=database)
+        self.parsed = parsed_pages(self)
+        self.parser.parse_directory(self.source_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def rows(self, query):
+        return sorted(self.parser.conn.execute(query).fetchall())
+
+    def test_aliases(self):
+        ls = os.path.join(self.coreutils, "ls.1")
+        self.assertEqual(
+            self.rows("SELECT name, section, file FROM manpages"),
+            [("dir", "1", ls), ("ls", "1", ls), ("vdir", "1", ls)])
+        self.assertEqual(
+            self.rows("SELECT name, target_name FROM aliases"),
+            [("dir", "ls"), ("vdir", "ls")])
+
+    def test_target_is_parsed_once(self):
+        ls = os.path.join(self.coreutils, "ls.1")
+        self.assertEqual(self.parsed.count(ls), 1)
+
+
+
+class AliasesTest(unittest.TestCase):
+    url = "https://www.carta.tech/"
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, "src")
+        coreutils = os.path.join(self.source_dir, "coreutils")
+        shutil.copytree(os.path.join(CORPUS, "coreutils"), coreutils)
+        with open(os.path.join(coreutils, "dir.1"), 'w') as fp:
+            fp.write(".so coreutils/ls.1\n")
+
+        self.database = os.path.join(self.tmp, "manpages.db")
+        shutil.copy("base.db", self.database)
+        ManDirectoryParser(database=self.database).parse_directory(
+            self.source_dir)
+
+        self.output_dir = os.path.join(self.tmp, "public_html")
+        self.alias = os.path.join(self.output_dir, "man-pages", "man1",
+                                  "dir.1.html")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def generate(self, aliases):
+        parser = ManDirectoryParser(database=self.database)
+        parser.generate_output(self.output_dir, AliasesTest.url,
+                               aliases=aliases)
+        parser.generate_indexes(self.output_dir, AliasesTest.url)
+        return parser
+
+    def read(self, path):
+        with open(path) as fp:
+            return fp.read()
+
+    def sitemap(self):
+        return self.read(os.path.join(self.output_dir, "man-pages", "man1",
+                                      "sitemap.xml"))
+
+    def test_copy(self):
+        parser = self.generate("copy")
+        self.assertNotIn('http-equiv="refresh"', self.read(self.alias))
+        self.assertIn("/man1/dir.1.html", self.sitemap())
+        self.assertFalse(os.path.exists(parser.aliases_map))
+
+    def test_redirect(self):
+        parser = self.generate("redirect")
+        self.assertIn('url=https://www.carta.tech/man-pages/man1/ls.1.html"',
+                      self.read(self.alias))
+        self.assertNotIn("/man1/dir.1.html", self.sitemap())
+        self.assertIn("/man1/ls.1.html", self.sitemap())
+        self.assertFalse(os.path.exists(parser.aliases_map))
+
+    def test_nginx(self):
+        parser = self.generate("nginx")
+        self.assertFalse(os.path.exists(self.alias))
+        self.assertEqual(self.read(parser.aliases_map),
+                         '"/man-pages/man1/dir.1.html" '
+                         '"/man-pages/man1/ls.1.html";\n')
+        self.assertNotIn("/man1/dir.1.html", self.sitemap())
+        self.assertIn("/man1/ls.1.html", self.sitemap())
+
+        for root, dirs, files in os.walk(self.output_dir):
+            self.assertFalse([name for name in files
+                              if name.endswith(".map")])
+
+    def test_map_quotes_uris(self):
+        parser = self.generate("nginx")
+        parser.write_aliases_map(parser.aliases_map, [
+            ('man1/a b;{"c"}\\.1.html', 'man1/$d e.1.html')])
+        self.assertEqual(self.read(parser.aliases_map),
+                         '"/man-pages/man1/a b;{\\"c\\"}\\\\.1.html" '
+                         '"/man-pages/man1/%24d%20e.1.html";\n')
+
+    def test_switching_modes(self):
+        self.generate("nginx")
+        parser = self.generate("copy")
+        self.assertNotIn('http-equiv="refresh"', self.read(self.alias))
+        self.assertFalse(os.path.exists(parser.aliases_map))
+
+        self.generate("redirect")
+        self.assertIn('http-equiv="refresh"', self.read(self.alias))
+
+        self.generate("nginx")
+        self.assertFalse(os.path.exists(self.alias))
+
+    def test_map_from_an_earlier_version_is_removed(self):
+        published_map = os.path.join(self.output_dir, "nginx-aliases.map")
+        os.makedirs(self.output_dir)
+        open(published_map, 'w').close()
+
+        self.generate("nginx")
+        self.assertFalse(os.path.exists(published_map))
+
+
+
+class AtomicDirparseTest(IncrementalTest):
+    def setUp(self):
+        super(AtomicDirparseTest, self).setUp()
+        self.tables = self.contents()
+
+        # The next dirparse has a page less, written as soon as it is checked
+        os.remove(self.tput)
+        patch(self, ManDirectoryParser, "batch_size", 1)
+
+    def contents(self, conn=None):
+        conn = conn or self.parser.conn
+        return [sorted(conn.execute("SELECT * FROM %s" % table).fetchall())
+                for table in ("manpages", "aliases", "catalog", "sources")]
+
+    def wrap(self, name, before):
+        """Calls before(number of the call) ahead of every call of
+        ManDirectoryParser.name during the test"""
+        method = ManDirectoryParser.__dict__[name]
+        calls = []
+
+        def wrapped(parser, *args, **kwargs):
+            calls.append(None)
+            before(len(calls))
+            return method(parser, *args, **kwargs)
+
+        patch(self, ManDirectoryParser, name, wrapped)
+
+    def failing(self, name, call=1):
+        """Makes the given call of ManDirectoryParser.name raise"""
+        def before(number):
+            if number == call:
+                raise RuntimeError("%s failed" % name)
+
+        self.wrap(name, before)
+
+    def test_failure_while_checking_pages(self):
+        self.failing("store_outcome", call=3)
+        self.assertRaises(RuntimeError, self.dirparse)
+        # sources keeps the outcomes stored so far, they are still valid
+        self.assertEqual(self.contents()[:3], self.tables[:3])
+
+    def test_failure_while_swapping(self):
+        self.failing("build_catalog")
+        self.assertRaises(RuntimeError, self.dirparse)
+        self.assertEqual(self.contents(), self.tables)
+
+    def test_dirparse_after_a_failure(self):
+        self.failing("build_catalog")
+        self.assertRaises(RuntimeError, self.dirparse)
+
+        self.dirparse()
+        self.assertNotIn("tput", self.rows("SELECT name FROM manpages"))
+        self.assertNotIn("tput", self.rows("SELECT name FROM catalog"))
+
+    def test_readers_see_the_last_dirparse(self):
+        reader = sqlite3.connect(self.database)
+        reader.text_factory = str
+        seen = []
+        self.wrap("store_outcome",
+                  lambda number: seen.append(self.contents(reader)[:3]))
+        self.wrap("build_catalog",
+                  lambda number: seen.append(self.contents(reader)[:3]))
+
+        self.dirparse()
+        self.assertTrue(seen)
+        for tables in seen:
+            self.assertEqual(tables, self.tables[:3])
+
+        self.assertNotEqual(self.contents(reader)[:3], self.tables[:3])
+
+
+
+class LowMemoryTest(IncrementalTest):
+    url = "https://www.carta.tech/"
+
+    def generate(self, name, jobs=1):
+        """Output files of a dirparse and generate on a database of its own,
+        and what they contain"""
+        database = os.path.join(self.tmp, "%s.db" % name)
+        output_dir = os.path.join(self.tmp, name)
+        shutil.copy("base.db", database)
+
+        parser = ManDirectoryParser(database=database)
+        parser.parse_directory(self.source_dir)
+        parser.generate_output(output_dir, LowMemoryTest.url, jobs=jobs)
+        parser.generate_indexes(output_dir, LowMemoryTest.url)
+
+        files = dict()
+        for root, dirs, names in os.walk(output_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, 'rb') as fp:
+                    files[os.path.relpath(path, output_dir)] = fp.read()
+
+        return files
+
+    def test_same_output(self):
+        files = self.generate("default")
+        self.assertIn("man-pages/man1/clear.1.html", files)
+        self.assertIn('href="../man1/tput.1.html"',
+                      files["man-pages/man1/clear.1.html"])
+
+        patch(self, ManDirectoryParser, "low_memory", True)
+        self.assertEqual(self.generate("low-memory", jobs=2), files)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""Checks of the text helpers the parser calls on every line"""
+
+import unittest
+
+from manpage import helpers
+from manpage.helpers import unescape, render_fonts, Macro, tokenize
+from manpage.benchmark import legacy_tokenize
+
+
+class UnescapeTest(unittest.TestCase):
+    longMessage = True
+
+    # (text, unescaped)
+    cases = [
+        ("", ""),
+        ("no escapes", "no escapes"),
+        ("\\-v", "-v"),
+        ("a\\ b", "a&nbsp;b"),
+        ("\\&.", "."),
+        ("\\%\\:", ""),
+        ("\\e", "&#92;"),
+        ("C:\\\\", "C:&#92;"),
+        ("\\\\\\\\", "&#92;&#92;"),
+        ("\\e\\-", "&#92;-"),
+        ("\\(co 2024", "&copy; 2024"),
+        ("\\[char46]", "&#46;"),
+        ("\\\\e", "&#92;e"),
+        ("\\\\(em", "&#92;(em"),
+        ("\\\\.", "&#92;."),
+        # Longest match: \\0 before \\ and \0, \*(lq before \(lq
+        ("\\\\0", "&#92;0"),
+        ("\\0", "&nbsp;"),
+        ("\\*(lqquoted\\*(rq", "&ldquo;quoted&rdquo;"),
+        ("\\(lqquoted\\(rq", "&ldquo;quoted&rdquo;"),
+        ("\\\\*(lq", "&#92;*(lq"),
+        # Unknown escapes are left alone
+        ("\\fBbold\\fR", "\\fBbold\\fR"),
+    ]
+
+    # (text, unescaped, unescaped by the chain of str.replace before)
+    changed = [
+        # An escaped backslash is a backslash, whatever follows it
+        ("\\\\ ", "&#92; ", "nbsp;"),
+        ("\\\\-", "&#92;-", "\\-"),
+        ("\\\\%", "&#92;%", "\\"),
+        # Narrow spaces are dropped
+        ("a\\|b\\^c", "abc", "a\\|b\\^c"),
+    ]
+
+    def test_escapes(self):
+        for text, unescaped in UnescapeTest.cases:
+            self.assertEqual(unescape(text), unescaped, repr(text))
+
+    def test_changed_escapes(self):
+        for text, unescaped, _ in UnescapeTest.changed:
+            self.assertEqual(unescape(text), unescaped, repr(text))
+
+
+class RenderFontsTest(unittest.TestCase):
+    longMessage = True
+
+    # (content, current tag, html). The same as the state machine before.
+    cases = [
+        ("plain", None, "plain"),
+        ("plain", "B", "<strong>plain</strong>"),
+        ("plain", "R", "plain"),
+        ("\\fBbold\\fR", None, "<strong>bold</strong>"),
+        ("\\fBbold\\fR", "I", "<em></em><strong>bold</strong>"),
+        ("\\f2it\\f1", None, "<em>it</em>"),
+        ("\\fSsmall\\fP", None, "<small>small</small>"),
+        ("\\fRx", "B", "<strong></strong>x"),
+        ("a\\fPb", "I", "<em>a</em>b"),
+        ("a\\fB", "SM", "<small>a</small><strong></strong>"),
+        # Nested switches: \fP only goes back one font
+        ("\\fBbold\\fIit\\fPback\\fP", None,
+         "<strong>bold</strong><em>it</em><strong>back</strong><em></em>"),
+        ("\\fB\\fI\\fP\\fP\\fP", None,
+         "<strong></strong><em></em><strong></strong><em></em>"
+         "<strong></strong>"),
+        # Only the last character of a [name] counts, [] is R
+        ("\\f[B]x\\f[]y", None, "<strong>x</strong>y"),
+        ("\\f[CB]x", None, "<strong>x</strong>"),
+        ("\\f[BI", None, ""),
+        ("\\f(CWx", None, "x"),
+        ("\\f(CBx\\fR", None, "<strong>x</strong>"),
+        ("\\f(BIx", None, "<strong>x</strong>"),
+        ("\\f$x\\fCy", None, "xy"),
+        ("\\fXz", None, "Xz"),
+        # Other escapes are kept, a trailing backslash is dropped
+        ("\\-x", None, "\\-x"),
+        ("x\\", None, "x"),
+        ("x\\f", None, "x"),
+    ]
+
+    def check(self):
+        for content, tag, html in RenderFontsTest.cases:
+            message = repr((content, tag))
+            self.assertEqual(Macro.process_fonts(content, tag), html, message)
+            if tag != "R":
+                self.assertEqual(render_fonts(content, tag), html, message)
+
+    def test_fonts(self):
+        self.check()
+
+    def test_fonts_from_the_cache(self):
+        self.check()
+        self.check()
+
+    def test_fonts_when_the_cache_is_emptied(self):
+        self.addCleanup(setattr, helpers, "FONT_CACHE_SIZE",
+                        helpers.FONT_CACHE_SIZE)
+        helpers.FONT_CACHE_SIZE = 2
+        helpers.font_cache.clear()
+
+        self.check()
+        self.assertLessEqual(len(helpers.font_cache), 2)
+        self.check()
+
+    def test_unknown_fonts(self):
+        for content in ("\\f(XX", "\\f(BX"):
+            self.assertRaises(Exception, Macro.process_fonts, content)
+
+        self.assertRaises(Exception, Macro.process_fonts, "x", "Q")
+
+
+class TokenizeTest(unittest.TestCase):
+    longMessage = True
+
+    # (arguments, tokens), the same with the tokenizer before
+    cases = [
+        ('', []),
+        ('one', ['one']),
+        ('a b  c', ['a', 'b', 'c']),
+        (' a ', ['a']),
+        ('"a b" c', ['a b', 'c']),
+        ('"a" "b"', ['a', 'b']),
+        ('""', ['']),
+        ('a "" b', ['a', '', 'b']),
+        ('"unclosed arg', ['unclosed arg']),
+        ('a"b c', ['a"b', 'c']),
+        ('"a"b', ['a', 'b']),
+        ('"a\\ b" c', ['a\\ b', 'c']),
+        ('a\\\\ b', ['a\\\\', 'b']),
+    ]
+
+    # (arguments, tokens, tokens of the tokenizer before)
+    changed = [
+        # "\ " does not split an argument
+        ('a\\ b c', ['a\\ b', 'c'], ['a\\', 'b', 'c']),
+        ('x\\ ', ['x\\ '], ['x\\']),
+        # "" in a quoted argument is a quote
+        ('"a ""b"" c"', ['a "b" c'], ['a ', 'b', ' c']),
+        ('"a"" b', ['a" b'], ['a', ' b']),
+    ]
+
+    def test_arguments(self):
+        for arguments, tokens in TokenizeTest.cases:
+            self.assertEqual(tokenize(arguments), tokens, repr(arguments))
+            self.assertEqual(legacy_tokenize(arguments), tokens,
+                             repr(arguments))
+
+    def test_changed_arguments(self):
+        for arguments, tokens, legacy_tokens in TokenizeTest.changed:
+            self.assertEqual(tokenize(arguments), tokens, repr(arguments))
+            self.assertEqual(legacy_tokenize(arguments), legacy_tokens,
+                             repr(arguments))
+
+
+if __name__ == '__main__':
+    unittest.main()
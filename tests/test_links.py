@@ -0,0 +1,224 @@
+"""Checks of the page sets and the link resolver of manpage.links"""
+
+import os
+import zlib
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from manpage.links import LinkResolver, LinkTargets, PageLookup
+
+SEE_ALSO = "cat(1), <b>Grep</b>(1), nothere(3)"
+
+LINKED = ('<a href="../man1/cat.1.html"><strong>cat</strong>(1)</a>, '
+          '<a href="../man1/grep.1.html"><strong>Grep</strong>(1)</a>, '
+          '<strong>nothere</strong>(3)')
+
+REFERENCES = (("cat.1", "cat.1"), ("Grep.1", "grep.1"), ("nothere.3", None))
+
+
+class LinkTargetsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "manpages.db.links")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def targets(self, names):
+        LinkTargets.build(self.path, names)
+        return LinkTargets(self.path)
+
+    def test_names(self):
+        targets = self.targets(["ls.1", "ls.10", "grep.1", "ls.1"])
+        self.assertEqual(len(targets), 3)
+        self.assertEqual(list(targets), ["grep.1", "ls.1", "ls.10"])
+        for name in ("ls.1", "ls.10", "grep.1"):
+            self.assertIn(name, targets)
+
+        for name in ("ls", "ls.", "s.1", "ls.2", "ls.100", "grep.1\n", ""):
+            self.assertNotIn(name, targets)
+
+    def test_collisions(self):
+        names = ["page%s.%s" % (i, i % 8) for i in range(500)]
+        targets = self.targets(names)
+
+        # Enough names that some start in the same slot
+        slots = set(zlib.crc32(name) & targets.mask for name in names)
+        self.assertLess(len(slots), len(names))
+
+        for name in names:
+            self.assertIn(name, targets)
+
+        for i in range(500, 1000):
+            self.assertNotIn("page%s.%s" % (i, i % 8), targets)
+
+    def test_empty(self):
+        targets = self.targets([])
+        self.assertEqual(len(targets), 0)
+        self.assertEqual(list(targets), [])
+        self.assertNotIn("ls.1", targets)
+
+    def test_pickled_by_path(self):
+        targets = self.targets(["ls.1"])
+        data = pickle.dumps(targets, pickle.HIGHEST_PROTOCOL)
+        self.assertLess(len(data), 200)
+
+        copy = pickle.loads(data)
+        self.assertEqual(copy.path, self.path)
+        self.assertIn("ls.1", copy)
+        self.assertNotIn("ls.2", copy)
+
+    def test_not_a_links_file(self):
+        with open(self.path, 'wb') as fp:
+            fp.write("SQLite format 3\0")
+
+        self.assertRaises(ValueError, LinkTargets, self.path)
+
+    def test_rebuilt_while_mapped(self):
+        targets = self.targets(["ls.1"])
+        LinkTargets.build(self.path, ["grep.1"])
+
+        self.assertIn("ls.1", targets)
+        self.assertIn("grep.1", LinkTargets(self.path))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+
+class PageLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp, "manpages.db")
+        self.conn = sqlite3.connect(self.database)
+        self.conn.execute("CREATE TABLE catalog (name text, section text)")
+        # ls(1) is in two packages
+        self.conn.executemany("INSERT INTO catalog VALUES (?, ?)", [
+            ("ls", "1"), ("ls", "1"), ("grep", "1"), ("ls.so", "3")])
+        self.conn.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def forget(self, name, section):
+        self.conn.execute("DELETE FROM catalog WHERE name = ? AND section = ?",
+                          (name, section))
+        self.conn.commit()
+
+    def test_pages(self):
+        lookup = PageLookup(self.database)
+        self.assertEqual(len(lookup), 3)
+        for page in ("ls.1", "grep.1", "ls.so.3"):
+            self.assertIn(page, lookup)
+
+        for page in ("ls.2", "ls", "so.3", "grep.1.1"):
+            self.assertNotIn(page, lookup)
+
+    def test_answers_are_cached(self):
+        lookup = PageLookup(self.database)
+        self.assertIn("ls.1", lookup)
+        self.assertNotIn("cat.1", lookup)
+        self.forget("ls", "1")
+        self.conn.execute("INSERT INTO catalog VALUES ('cat', '1')")
+        self.conn.commit()
+
+        self.assertIn("ls.1", lookup)
+        self.assertNotIn("cat.1", lookup)
+
+    def test_cache_is_bounded(self):
+        self.addCleanup(setattr, PageLookup, "cache_size",
+                        PageLookup.cache_size)
+        PageLookup.cache_size = 2
+        lookup = PageLookup(self.database)
+        pages = ("ls.1", "grep.1", "ls.so.3")
+        for page in pages:
+            self.assertIn(page, lookup)
+
+        # The cache drops answers in about least recently used order, the
+        # last one is still there
+        cached = [page for page in pages if lookup.cache.get(page)]
+        self.assertEqual(len(cached), 2)
+        self.assertIn("ls.so.3", cached)
+
+    def test_pickled_by_database(self):
+        lookup = PageLookup(self.database)
+        data = pickle.dumps(lookup, pickle.HIGHEST_PROTOCOL)
+        self.assertLess(len(data), 200)
+
+        copy = pickle.loads(data)
+        self.assertEqual(len(copy), 3)
+        self.assertIn("grep.1", copy)
+
+    def test_forked_process_connects_again(self):
+        lookup = PageLookup(self.database)
+        conn = lookup.connection
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                found = "grep.1" in lookup and "ls.1" in lookup
+                ok = found and lookup.connection is not conn
+            finally:
+                os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertIs(lookup.connection, conn)
+
+
+class LinkResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.resolver = LinkResolver({"cat.1", "grep.1", "Xorg.1"})
+
+    def test_resolve(self):
+        self.assertEqual(self.resolver.resolve("cat.1"), "cat.1")
+        self.assertEqual(self.resolver.resolve("Xorg.1"), "Xorg.1")
+        self.assertEqual(self.resolver.resolve("CAT.1"), "cat.1")
+        self.assertEqual(self.resolver.resolve("cat.8"), None)
+
+    def test_linkify(self):
+        self.assertEqual(self.resolver.linkify(SEE_ALSO),
+                         (LINKED, REFERENCES))
+        self.assertEqual(self.resolver.stats, {"misses": 1})
+
+    def test_memo_hit(self):
+        self.resolver.linkify(SEE_ALSO)
+        self.assertEqual(self.resolver.linkify(SEE_ALSO),
+                         (LINKED, REFERENCES))
+        self.assertEqual(self.resolver.stats, {"misses": 1, "hits": 1})
+
+    def test_text_without_references_is_skipped(self):
+        text = "no references (here)"
+        self.assertEqual(self.resolver.linkify(text), (text, ()))
+        self.assertEqual(self.resolver.stats, {"skipped": 1})
+        self.assertEqual(self.resolver.memo, {})
+
+    def test_no_pages(self):
+        resolver = LinkResolver(set())
+        self.assertEqual(resolver.linkify(SEE_ALSO), (SEE_ALSO, ()))
+        self.assertEqual(resolver.stats, {"skipped": 1})
+
+    def test_long_fragments_are_not_memoized(self):
+        text = SEE_ALSO + " " * LinkResolver.memo_max_length
+        for _ in range(2):
+            self.assertEqual(self.resolver.linkify(text)[1], REFERENCES)
+
+        self.assertEqual(self.resolver.stats, {"misses": 2})
+        self.assertEqual(self.resolver.memo, {})
+
+    def test_full_memo_is_emptied(self):
+        resolver = LinkResolver({"cat.1"}, memo_size=2)
+        for section in "1234":
+            text = "cat(%s)" % section
+            self.assertEqual(resolver.linkify(text)[1],
+                             (("cat.%s" % section,
+                               "cat.1" if section == "1" else None), ))
+            self.assertLessEqual(len(resolver.memo), 2)
+
+        self.assertEqual(resolver.linkify("cat(1)")[1],
+                         (("cat.1", "cat.1"), ))
+        self.assertEqual(resolver.stats, {"misses": 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Checks of the parser on pages of benchmarks/corpus"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from manpage.parser import ManpageParser, CustomMacros, MalformedPage
+from manpage.directory import parse_page
+
+CORPUS = "benchmarks/corpus"
+
+
+class CustomMacrosTest(unittest.TestCase):
+    def setUp(self):
+        self.macros = CustomMacros()
+        self.macros.add_macro("FN")
+        self.macros.add_line("\\fI\\|\\\\$1\\|\\fP")
+        self.macros.add_macro("XX")
+        self.macros.add_line(".B \\\\$2 \\$1 \\\\$3")
+        self.macros.add_line("all: \\\\$* quoted: \\\\$@")
+
+    def test_arguments(self):
+        self.assertEqual(self.macros.expand("FN", "/etc/profile"),
+                         ["\\fI\\|/etc/profile\\|\\fP"])
+
+    def test_missing_arguments_are_empty(self):
+        self.assertEqual(self.macros.expand("XX", "a b")[0], ".B b a ")
+
+    def test_all_arguments(self):
+        self.assertEqual(self.macros.expand("XX", 'a "b c"')[1],
+                         'all: a b c quoted: "a" "b c"')
+
+    def test_every_call_gets_its_arguments(self):
+        self.assertEqual(self.macros.expand("FN", "/etc/hosts"),
+                         ["\\fI\\|/etc/hosts\\|\\fP"])
+        self.assertEqual(self.macros.macros["FN"],
+                         ["\\fI\\|\\\\$1\\|\\fP"])
+
+
+class CustomMacrosPageTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        page = ManpageParser(CORPUS + "/bash/bash.1").process()
+        cls.html = page.html()
+
+    def test_files_entries(self):
+        # .FN /etc/profile and friends in FILES
+        for name in ("/bin/bash", "/etc/profile", "/etc/bash.bashrc",
+                     "~/.bashrc", "~/.bash_logout"):
+            self.assertIn("<p><em>%s</em></p>" % name, self.html)
+
+    def test_no_macro_arguments_left(self):
+        self.assertEqual(self.html.count("&#92;$1"), 0)
+
+
+class MalformedPageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.page = os.path.join(self.tmp, "loop.1")
+        with open(self.page, 'w') as fp:
+            fp.write('.TH LOOP 1\n.de XX\n.XX\n..\n.SH NAME\n.XX\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_macro_calling_itself(self):
+        with self.assertRaises(MalformedPage):
+            ManpageParser(self.page).process()
+
+    def test_reported_as_malformed(self):
+        self.assertEqual(parse_page(self.page),
+                         (self.page, "malformed",
+                          "custom macros nested too deep"))
+
+
+if __name__ == '__main__':
+    unittest.main()
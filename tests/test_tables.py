@@ -0,0 +1,134 @@
+"""Checks of Table.rows on the tbl tables of benchmarks/corpus"""
+
+import unittest
+
+from manpage.parser import ManpageParser
+from manpage.manpage import Table
+from manpage.helpers import tbl_columns
+from manpage.benchmark import page_tables
+
+CORPUS = "benchmarks/corpus"
+
+
+def corpus_table(page_file):
+    tables = list(page_tables(ManpageParser(page_file).process()))
+    assert len(tables) == 1, tables
+    return tables[0]
+
+
+def table(*lines):
+    table = Table()
+    for line in lines:
+        table.append(line)
+
+    return table
+
+
+class SocketTableTest(unittest.TestCase):
+    """tab(:) and text blocks run together as T}:T{"""
+
+    @classmethod
+    def setUpClass(cls):
+        table = corpus_table(CORPUS + "/manpages-dev/socket.2")
+        cls.rows = list(table.rows())
+
+    def test_header(self):
+        self.assertEqual(self.rows[0], ["Name", "Purpose", "Man page"])
+
+    def test_blocks_next_to_each_other(self):
+        self.assertEqual(self.rows[1], [
+            "<strong>AF_UNIX</strong>", "Local communication",
+            "<strong>unix</strong>(7)"
+        ])
+
+    def test_block_with_macros(self):
+        self.assertEqual(self.rows[2], [
+            "<strong>AF_LOCAL</strong>",
+            "Synonym for <strong>AF_UNIX</strong>", ""
+        ])
+
+    def test_plain_cell_between_blocks(self):
+        self.assertEqual(self.rows[3], [
+            "<strong>AF_INET</strong>", "IPv4 Internet protocols",
+            "<strong>ip</strong>(7)"
+        ])
+
+    def test_empty_last_cell(self):
+        self.assertEqual(self.rows[5], [
+            "<strong>AF_IPX</strong>", "IPX - Novell protocols", ""
+        ])
+
+    def test_every_row_has_the_columns_of_the_format(self):
+        self.assertEqual(len(self.rows), 25)
+        self.assertEqual({len(row) for row in self.rows}, {3})
+
+
+class TputTableTest(unittest.TestCase):
+    """= rules, and a text block in the second column"""
+
+    @classmethod
+    def setUpClass(cls):
+        table = corpus_table(CORPUS + "/ncurses-bin/tput.1")
+        cls.rows = list(table.rows())
+
+    def test_rules_are_not_rows(self):
+        self.assertEqual([row[0] for row in self.rows], [
+            "exit code", "<strong>0</strong>", "<strong>1</strong>",
+            "<strong>2</strong>", "<strong>3</strong>", "<strong>4</strong>",
+            "<strong>&gt;4</strong>"
+        ])
+
+    def test_block_lines_are_joined(self):
+        self.assertEqual(self.rows[1][1], (
+            "(<em>capname</em> is a numeric variable that is not specified "
+            "in the <strong>terminfo</strong>(5) database for this terminal "
+            "type, e.g. <strong>tput -T450 lines</strong> and "
+            "<strong>tput -Thp2621 xmc</strong>)"))
+
+
+class FormatTest(unittest.TestCase):
+    def test_columns_between_bars(self):
+        self.assertEqual(tbl_columns("|l|l|l|."), 3)
+
+    def test_columns_with_arguments(self):
+        self.assertEqual(tbl_columns("l1 lw40 l."), 3)
+        self.assertEqual(tbl_columns("lB lw(2.5i) n."), 3)
+
+    def test_widest_row_of_keys(self):
+        self.assertEqual(tbl_columns("c s s, l l l."), 3)
+
+    def test_boxed_table(self):
+        # From llvm-objcopy.1
+        rows = table(
+            "center;", "|l|l|l|.", "_",
+            "T{", "Character", "T}\tT{", "Meaning", "T}\tT{", "Equivalent",
+            "T}", "_",
+            "T{", "\\fB?\\fP", "T}\tT{", "Any single character", "T}\tT{",
+            "\\fB\\&.\\fP", "T}", "_").rows()
+
+        self.assertEqual(list(rows), [
+            ["Character", "Meaning", "Equivalent"],
+            ["\\fB?\\fP", "Any single character", "\\fB\\&.\\fP"],
+        ])
+
+
+class ShortRowsTest(unittest.TestCase):
+    def test_short_row_is_padded(self):
+        rows = table("l l l.", "a\tb\tc", "d\te", "f").rows()
+        self.assertEqual(list(rows), [["a", "b", "c"], ["d", "e", ""],
+                                      ["f", "", ""]])
+
+    def test_short_row_in_the_corpus(self):
+        rows = corpus_table(CORPUS + "/manpages-dev/socket.2").rows()
+        decnet = [row for row in rows if "AF_DECnet" in row[0]]
+        self.assertEqual(decnet, [[
+            "<strong>AF_DECnet</strong>", "DECet protocol sockets", ""
+        ]])
+
+    def test_unfinished_block(self):
+        rows = table("l l.", "a\tb", "c\tT{", "text", "that goes on").rows()
+        self.assertEqual(list(rows), [["a", "b"], ["c", "text that goes on"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
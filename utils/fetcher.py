@@ -5,7 +5,6 @@ import logging
 import requests
 from tempfile import mkstemp
 import os
-import gzip
 
 package_directory = os.path.dirname(os.path.abspath(__file__))
 
@@ -91,11 +90,8 @@ class DebianManpageFetcher(object):
                     path, basename = os.path.split(file)
                     mandir = os.path.basename(path)
 
-                    compressed = False
-                    if basename.endswith(".gz"):
-                        compressed = True
-                        basename = basename.rsplit('.', 1)[0]
-
+                    # Compressed pages are kept as they are, the parser
+                    # reads them directly
                     final_page_directory = os.path.join(output_dir, namespace,
                                                         mandir)
 
@@ -106,9 +102,6 @@ class DebianManpageFetcher(object):
 
                     final_path = os.path.join(final_page_directory, basename)
 
-                    if compressed:
-                        file_contents = gzip.GzipFile(fileobj=file_contents)
-
                     logging.debug("Writing new page %s", final_path)
 
                     fp = open(final_path, "w")